@@ -0,0 +1,103 @@
+"""
+Canonical serialization of Bismuth blocks for block hash recomputation
+The node hashes str() of the list of converted transaction tuples, serialize_block builds
+the same text directly, without the intermediate tuples and list
+Run the module to check it against str() on the built-in corpus
+"""
+
+import hashlib
+from quantizer import quantize_two, quantize_eight
+from fixed_point import format_two, format_eight
+
+# timestamp and amount only contain digits, '.' and '-', their repr is the string in single quotes
+ROW_FORMAT = "('%s', %r, %r, '%s', %r, %r, %r, %r)"
+
+
+def convert_row(transaction):
+    """The converted transaction tuple hashed by the node"""
+    return ('%.2f' % quantize_two(transaction[1]),
+            str(transaction[2])[:56],
+            str(transaction[3])[:56],
+            '%.8f' % quantize_eight(transaction[4]),
+            str(transaction[5])[:684],
+            str(transaction[6])[:1068],
+            str(transaction[10]),
+            str(transaction[11]))
+
+
+class BlockSerializer:
+    """Serializes blocks into a buffer of row strings reused from block to block"""
+
+    def __init__(self):
+        self.rows = []
+
+    def serialize(self, transactions):
+        """Returns str([convert_row(transaction) for transaction in transactions])"""
+        rows = self.rows
+        rows.clear()
+        append = rows.append
+        for transaction in transactions:
+            append(ROW_FORMAT % (format_two(transaction[1]),
+                                 str(transaction[2])[:56],
+                                 str(transaction[3])[:56],
+                                 format_eight(transaction[4]),
+                                 str(transaction[5])[:684],
+                                 str(transaction[6])[:1068],
+                                 str(transaction[10]),
+                                 str(transaction[11])))
+        return "[" + ", ".join(rows) + "]"
+
+
+_serializer = BlockSerializer()
+
+
+def serialize_block(transactions):
+    return _serializer.serialize(transactions)
+
+
+def compute_block_hash(transactions, db_block_hash_prev):
+    """sha224 block hash of the transaction rows of a block chained on the previous block hash"""
+    return hashlib.sha224((_serializer.serialize(transactions) + db_block_hash_prev).encode("utf-8")).hexdigest()
+
+
+def corpus():
+    """Yields lists of transaction rows covering the quoting, escaping, truncation and number formats"""
+    address = "4edadac9093d9326ee4b17f869b14f1a2534f96f9c5d7b48dc9acaed"
+    texts = ["", "0", "'", '"', "'\"", "\"'", "''", '""', "\\", "\\'", "\\\"", "it's", 'say "hi"',
+             "both ' and \"", "\n", "\r\n", "\t", "\x00", "\x07\x1b\x7f", "\x80\x9f\xa0\xad", "é", "€",
+             "  ", "﻿", "\U0001f600", "\U000e0001", "\ud800", "\udfff", "zip=%s %r {}",
+             "a" * 2000, "'" * 700, "\\" * 700, "op:" + "é" * 1100]
+    numbers = [0, 1, -1, 0.005, 0.015, 0.125, 1.005, 2.675, 1e-9, 5e-9, 1.5e-8, 2.5e-8, 1e-8, 123456789.123456789,
+               1530000000.005, 1530000000.015, 1600000000.995, 10.0, 7.8125e-3, 99999999.999999995,
+               "0", "1.005", "0.000000005", "0.000000015", "-0.5", "1e3", "12345.6789012345"]
+    values = texts + [None, 0, 1, -5, 3.5, 1e20]
+
+    yield []
+    for text in values:
+        yield [(1, 1530000000.01, text, text, 1, text, text, "hash", 0, 0, text, text)]
+    for number in numbers:
+        yield [(1, number, address, address, number, "0", "0", "hash", 0, 0, "0", "0")]
+    yield [(1, 1530000000.01 + i, address, text, numbers[i % len(numbers)], text, text, "hash", 0,
+            0, "op", text) for i, text in enumerate(texts)]
+
+    # every code point, in strings of 256 code points
+    for start in range(0, 0x110000, 256):
+        text = "".join(chr(code) for code in range(start, start + 256))
+        yield [(1, start, text[:100], text[100:], start, text, text, "hash", 0, 0, text, text)]
+
+
+def self_check():
+    """Compares serialize_block with str() of the converted rows on the corpus, returns the number of differences"""
+    differences = 0
+    blocks = 0
+    for transactions in corpus():
+        blocks += 1
+        if serialize_block(transactions) != str([convert_row(transaction) for transaction in transactions]):
+            print("Serialization mismatch: {!r}".format(transactions)[:200])
+            differences += 1
+    print("Blocks checked: {}, mismatches: {}".format(blocks, differences))
+    return differences
+
+
+if __name__ == "__main__":
+    raise SystemExit(1 if self_check() else 0)
@@ -0,0 +1,94 @@
+"""
+Streaming access to the blocks of a Bismuth ledger
+One ordered scan of the transactions table replaces a separate query per block
+"""
+
+BATCH_SIZE = 10000  # rows per fetchmany call
+
+
+def iter_blocks(cursor, start, end=None, step=1):
+    """Yields (block_height, coinbase, transactions) for every block from start to end, in height order
+
+    transactions are all rows of the block in rowid order, as returned by
+    SELECT * FROM transactions WHERE block_height = ?
+    coinbase is the reward row of the block, None if the block has none
+    With step, only blocks whose height is a multiple of step are read
+    """
+    query = "SELECT * FROM transactions WHERE block_height >= ? "
+    params = (start,)
+    if end is not None:
+        query += "AND block_height <= ? "
+        params += (end,)
+    if step != 1:
+        query += "AND block_height % ? = 0 "
+        params += (step,)
+    cursor.execute(query + "ORDER BY block_height, rowid", params)
+
+    block_height = None
+    coinbase = None
+    transactions = []
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            if row[0] != block_height:
+                if transactions:
+                    yield block_height, coinbase, transactions
+                block_height = row[0]
+                coinbase = None
+                transactions = []
+            if coinbase is None and row[9] != 0:
+                coinbase = row
+            transactions.append(row)
+
+    if transactions:
+        yield block_height, coinbase, transactions
+
+
+def iter_diff_rows(cursor, start, end=None):
+    """Yields (block_height, difficulty, timestamp, miner_address, block_hash, nonce) for blocks above start
+
+    misc is joined with the reward rows of transactions, so only the columns
+    needed by the difficulty check are read, in height order
+    """
+    query = ("SELECT misc.block_height, misc.difficulty, transactions.timestamp, transactions.address, "
+             "transactions.block_hash, transactions.openfield "
+             "FROM misc JOIN transactions ON transactions.block_height = misc.block_height "
+             "WHERE misc.block_height > ? AND transactions.reward != 0 ")
+    if end is None:
+        cursor.execute(query + "ORDER BY misc.block_height", (start,))
+    else:
+        cursor.execute(query + "AND misc.block_height <= ? ORDER BY misc.block_height", (start, end))
+
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def iter_mirror_blocks(cursor):
+    """Yields (block_height, transactions) for the mirror rows of every block, by increasing absolute height
+
+    block_height is the negative height of the mirror rows, transactions are in rowid order
+    """
+    cursor.execute("SELECT * FROM transactions WHERE block_height < 0 ORDER BY block_height DESC, rowid")
+
+    block_height = None
+    transactions = []
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            if row[0] != block_height:
+                if transactions:
+                    yield block_height, transactions
+                block_height = row[0]
+                transactions = []
+            transactions.append(row)
+
+    if transactions:
+        yield block_height, transactions
@@ -0,0 +1,127 @@
+"""
+Script comparing the transactions of two Bismuth ledgers, e.g. hyper.db and ledger.db before a snapshot upload
+Usage: python3 db_compare.py hyper.db ledger.db
+
+The shared height range is split into segments whose digests are computed in parallel in both
+databases. A segment digest is the sum of the hashes of its rows, so it does not depend on the
+row order. Only the segments that differ are split again, down to single blocks.
+"""
+
+import sqlite3
+import hashlib
+import argparse
+import multiprocessing
+from collections import Counter
+
+COLUMNS = ("block_height", "timestamp", "address", "recipient", "amount", "signature", "public_key",
+           "block_hash", "fee", "reward", "operation", "openfield")
+SEGMENT = 10000  # blocks per segment of the first pass
+MODULUS = 2 ** 128
+
+
+def connect_readonly(db):
+    ledger_check = sqlite3.connect("file:{}?mode=ro".format(db), uri=True)
+    ledger_check.text_factory = str
+    return ledger_check
+
+
+def select_rows(db, start, end, columns):
+    ledger_check = connect_readonly(db)
+    return ledger_check, ledger_check.execute("SELECT {} FROM transactions WHERE block_height >= ? AND "
+                                              "block_height < ?".format(", ".join(columns)), (start, end))
+
+
+def segment_digest(args):
+    """Worker: (row count, sum of the row hashes) of the rows of blocks start..end-1"""
+    db, start, end, columns = args
+    count = 0
+    total = 0
+    ledger_check, rows = select_rows(db, start, end, columns)
+    for row in rows:
+        count += 1
+        total += int.from_bytes(hashlib.blake2b(repr(row).encode("utf-8"), digest_size=16).digest(), 'little')
+    ledger_check.close()
+    return count, total % MODULUS
+
+
+def segments(first, last, size=SEGMENT):
+    """Splits heights first..last-1 into (start, end) segments of size blocks"""
+    return [(start, min(start + size, last)) for start in range(first, last, size)]
+
+
+def differing_segments(pool, db1, db2, ranges, columns):
+    """Returns the ranges whose digests differ between db1 and db2, both databases are hashed in one map"""
+    jobs = [(db, start, end, columns) for db in (db1, db2) for start, end in ranges]
+    results = pool.map(segment_digest, jobs, chunksize=1)
+    return [r for r, a, b in zip(ranges, results[:len(ranges)], results[len(ranges):]) if a != b]
+
+
+def block_difference(db1, db2, block_height, columns):
+    """(rows only in db1, rows only in db2) of a block"""
+    found = []
+    for db in (db1, db2):
+        ledger_check, rows = select_rows(db, block_height, block_height + 1, columns)
+        found.append(Counter(rows))
+        ledger_check.close()
+    return sum((found[0] - found[1]).values()), sum((found[1] - found[0]).values())
+
+
+def compare_dbs(db1, db2, first, last, columns=COLUMNS, segment=SEGMENT, workers=None):
+    """Returns the heights of first..last-1 whose rows differ between db1 and db2
+
+    Differing segments are split into one sub-range per worker each round until single blocks remain.
+    """
+    workers = workers or multiprocessing.cpu_count()
+    parts = max(2, workers)
+    heights = []
+    with multiprocessing.Pool(workers) as pool:
+        ranges = differing_segments(pool, db1, db2, segments(first, last, segment), columns)
+        while ranges:
+            heights.extend(start for start, end in ranges if end - start == 1)
+            split = [r for start, end in ranges if end - start > 1
+                     for r in segments(start, end, max(1, -(-(end - start) // parts)))]
+            ranges = differing_segments(pool, db1, db2, split, columns) if split else []
+    return sorted(heights)
+
+
+def shared_range(db1, db2):
+    """(1, last + 1) for the last height present in both databases"""
+    last = []
+    for db in (db1, db2):
+        ledger_check = connect_readonly(db)
+        last.append(ledger_check.execute("SELECT max(block_height) FROM transactions").fetchone()[0] or 0)
+        ledger_check.close()
+    return 1, min(last) + 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compare the transactions of two Bismuth ledgers')
+    parser.add_argument('db1')
+    parser.add_argument('db2')
+    parser.add_argument('--first', type=int, default=None, help='first height compared (default 1)')
+    parser.add_argument('--last', type=int, default=None,
+                        help='last height compared (default the last height present in both)')
+    parser.add_argument('--columns', default=",".join(COLUMNS),
+                        help='comma separated columns compared (default all)')
+    parser.add_argument('--segment', type=int, default=SEGMENT,
+                        help='blocks per segment of the first pass (default {})'.format(SEGMENT))
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes (default: number of cpus)')
+    args = parser.parse_args()
+
+    first, last = shared_range(args.db1, args.db2)
+    if args.first is not None:
+        first = args.first
+    if args.last is not None:
+        last = args.last + 1
+    columns = tuple(column.strip() for column in args.columns.split(","))
+
+    print("---> Comparing blocks {} to {}".format(first, last - 1))
+    heights = compare_dbs(args.db1, args.db2, first, last, columns, args.segment, args.workers)
+    for height in heights:
+        only1, only2 = block_difference(args.db1, args.db2, height, columns)
+        print("Block {} differs: {} rows only in {}, {} rows only in {}".format(height, only1, args.db1,
+                                                                                only2, args.db2))
+    if not heights:
+        print("All blocks match")
+    raise SystemExit(1 if heights else 0)
@@ -0,0 +1,103 @@
+"""
+Integer fixed-point arithmetic for the verification hot loops
+Timestamps are handled in centiseconds and amounts in units of 1e-8 BIS, rounded exactly like
+quantize_two and quantize_eight: ROUND_HALF_EVEN of the exact value of the float
+Run the module to check it against the quantizer on the built-in corpus
+"""
+
+import math
+from decimal import Decimal
+from quantizer import quantize_two, quantize_eight, quantize_ten
+
+SCALE = {2: 10 ** 2, 8: 10 ** 8, 10: 10 ** 10}
+
+
+def round_half_even(num, den):
+    """num / den rounded half to even like Decimal.quantize, for ints or integer numpy arrays, den > 0"""
+    q = num // den
+    r = num - q * den
+    return q + ((2 * r > den) | ((2 * r == den) & (q % 2 == 1)))
+
+
+def to_units(value, places):
+    """value * 10**places rounded half to even, as an int: int(quantize(value) * 10**places)
+
+    Floats are converted exactly through as_integer_ratio, like Decimal(float).
+    Other types (str, Decimal) go through Decimal.
+    """
+    if type(value) is float and math.isfinite(value):
+        num, den = value.as_integer_ratio()
+        q, r = divmod(num * SCALE[places], den)
+        if 2 * r > den or 2 * r == den and q & 1:
+            q += 1
+        return q
+    if type(value) is int:
+        return value * SCALE[places]
+    return int(Decimal(value).scaleb(places).quantize(Decimal(1)))
+
+
+def format_two(value):
+    """'%.2f' % quantize_two(value)"""
+    if type(value) is float and math.isfinite(value):
+        num, den = value.as_integer_ratio()
+        q, r = divmod(num * 100, den)
+        if 2 * r > den or 2 * r == den and q & 1:
+            q += 1
+        if q == 0 and num < 0 or value == 0 and math.copysign(1.0, value) < 0:
+            return '-0.00'
+        return '%.2f' % (q / 100)
+    if type(value) is int:
+        return '%.2f' % value
+    return '%.2f' % quantize_two(value)
+
+
+def format_eight(value):
+    """'%.8f' % quantize_eight(value)"""
+    if type(value) is float and math.isfinite(value):
+        num, den = value.as_integer_ratio()
+        q, r = divmod(num * 100000000, den)
+        if 2 * r > den or 2 * r == den and q & 1:
+            q += 1
+        if q == 0 and num < 0 or value == 0 and math.copysign(1.0, value) < 0:
+            return '-0.00000000'
+        return '%.8f' % (q / 100000000)
+    if type(value) is int:
+        return '%.8f' % value
+    return '%.8f' % quantize_eight(value)
+
+
+def corpus():
+    """Yields values covering ties, signs, float conversion and large magnitudes"""
+    yield from [0, 1, -1, 180, 1530000000, 10 ** 12, 0.0, -0.0, 1.0, -1.0, 0.5, 0.125, 0.375, -0.125, 0.005, 0.015,
+                -0.005, 1.005, 2.675, 1e-9, -1e-9, 5e-9, 1.5e-8, 2.5e-8, 1e-8, 3.90625e-3, 5.9604644775390625e-8,
+                123456789.123456789, 99999999.999999995, 1530000000.005, 1530000000.015, 1600000000.995,
+                1e15, 2.0 ** 53, 1e-300, 5e-324, 108.9,
+                "0", "1.005", "0.000000005", "0.000000015", "-0.5", "1e3", "12345.6789012345",
+                Decimal("0.125"), Decimal("-0.00000000500")]
+    for i in range(1, 50001):
+        yield i / 1000
+        yield i / 1e9
+        yield -i / 7
+        yield 1400000000 + i / 200
+        yield (i * 2654435761 % 10 ** 12) / 10 ** (i % 13)
+
+
+def self_check():
+    """Compares to_units and the formats with the quantizer on the corpus, returns the number of differences"""
+    differences = 0
+    values = 0
+    for value in corpus():
+        values += 1
+        expected = ('%.2f' % quantize_two(value), '%.8f' % quantize_eight(value),
+                    int(quantize_two(value) * 100), int(quantize_eight(value) * 10 ** 8),
+                    int(quantize_ten(value) * 10 ** 10))
+        found = (format_two(value), format_eight(value), to_units(value, 2), to_units(value, 8), to_units(value, 10))
+        if found != expected:
+            print("Fixed point mismatch: {!r} {} {}".format(value, found, expected))
+            differences += 1
+    print("Values checked: {}, mismatches: {}".format(values, differences))
+    return differences
+
+
+if __name__ == "__main__":
+    raise SystemExit(1 if self_check() else 0)
@@ -0,0 +1,93 @@
+"""
+Cache of parsed public keys for transaction signature verification
+Busy addresses sign many transactions, their RSA key is imported once instead of once per transaction
+"""
+
+import re
+import base64
+import hashlib
+from collections import OrderedDict
+from Cryptodome.Hash import SHA
+from Cryptodome.PublicKey import RSA
+from Cryptodome.Signature import PKCS1_v1_5
+from polysign.signerfactory import SignerFactory
+
+RSA_ADDRESS = re.compile('[abcdef0123456789]{56}$')
+
+
+class VerifierCache:
+    """Bounded LRU cache of PKCS1_v1_5 verifiers keyed by (address, public key digest)
+
+    verify() checks a signature like SignerFactory.verify_bis_signature and raises on an invalid one
+    or on a key that does not belong to the address.
+    Keys of non RSA addresses are not cached, they go through SignerFactory.
+    """
+
+    def __init__(self, size=4096):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.verifiers = OrderedDict()
+
+    def verifier(self, address, public_key):
+        key = (address, hashlib.blake2b(public_key.encode("utf-8"), digest_size=16).digest())
+        verifier = self.verifiers.get(key)
+        if verifier is not None:
+            self.hits += 1
+            self.verifiers.move_to_end(key)
+            return verifier
+
+        self.misses += 1
+        public_key_pem = base64.b64decode(public_key).decode("utf-8")
+        # address of the key as polysign's public_key_to_address, checked once per cached key
+        if address != hashlib.sha224(public_key_pem.encode("utf-8")).hexdigest():
+            raise ValueError("Attempt to spend from a wrong address")
+        verifier = PKCS1_v1_5.new(RSA.importKey(public_key_pem))
+        self.verifiers[key] = verifier
+        if len(self.verifiers) > self.size:
+            self.verifiers.popitem(last=False)
+        return verifier
+
+    def verify(self, signature, public_key, buffer, address):
+        if self.size <= 0 or not RSA_ADDRESS.match(address):
+            SignerFactory.verify_bis_signature(signature, public_key, buffer, address)
+            return
+
+        if not self.verifier(address, public_key).verify(SHA.new(buffer), base64.b64decode(signature)):
+            raise ValueError("Invalid signature from {}".format(address))
+
+
+def self_check():
+    """Compares VerifierCache with SignerFactory on valid, forged and wrong address signatures,
+    returns the number of differences"""
+    key = RSA.generate(1024)
+    public_key_pem = key.publickey().exportKey().decode("utf-8")
+    public_key = base64.b64encode(public_key_pem.encode("utf-8")).decode("utf-8")
+    address = hashlib.sha224(public_key_pem.encode("utf-8")).hexdigest()
+    other_address = hashlib.sha224(b"other").hexdigest()
+    buffer = b"('1530000000.00', 'a', 'b', '1.00000000', '', '')"
+    signature = base64.b64encode(PKCS1_v1_5.new(key).sign(SHA.new(buffer))).decode("utf-8")
+
+    cases = [("valid", signature, buffer, address),
+             ("forged buffer", signature, buffer + b" ", address),
+             ("wrong address", signature, buffer, other_address),
+             ("valid again", signature, buffer, address)]
+    cache = VerifierCache()
+    differences = 0
+    for name, case_signature, case_buffer, case_address in cases:
+        results = []
+        for verify in (SignerFactory.verify_bis_signature, cache.verify):
+            try:
+                verify(case_signature, public_key, case_buffer, case_address)
+                results.append(True)
+            except ValueError:
+                results.append(False)
+        if results[0] != results[1]:
+            print("Verification mismatch on {}: SignerFactory {}, VerifierCache {}".format(name, *results))
+            differences += 1
+    print("Cases checked: {}, mismatches: {}".format(len(cases), differences))
+    return differences
+
+
+if __name__ == "__main__":
+    raise SystemExit(1 if self_check() else 0)
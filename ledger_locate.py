@@ -0,0 +1,158 @@
+"""
+Script locating the first divergent block of a Bismuth ledger
+Run the script inside the main Bismuth folder ~/Bismuth when hash_blocks_until does not match DB_HASH
+
+Segments of blocks are hashed in parallel and compared with a manifest of segment hashes made
+from a trusted ledger (--create). The first mismatching segment is then narrowed down to a single
+height, by parallel bisection against a trusted ledger (--reference) or, without one, by
+recomputing the block hashes of the segment.
+"""
+
+import hashlib
+import json
+import argparse
+import multiprocessing
+from block_stream import iter_blocks
+from ledger_verify import verify_block, connect_readonly
+from db_compare import segments
+
+SEGMENT = 10000  # blocks per manifest segment
+
+
+def segment_digest(args):
+    """Worker: sha224 of the block_hash of all rows of blocks start..end-1 and of their mirror rows
+
+    Rows are hashed with their height in (block_height, block_hash) order, so the digest
+    does not depend on the rowid order of the table.
+    """
+    db, start, end = args
+    sha224 = hashlib.sha224()
+    with connect_readonly(db) as ledger_check:
+        h3 = ledger_check.cursor()
+        for query, params in (("block_height >= ? AND block_height < ?", (start, end)),
+                              ("block_height > ? AND block_height <= ?", (-end, -start))):
+            for row in h3.execute("SELECT block_height, block_hash FROM transactions WHERE " + query +
+                                  " ORDER BY block_height, block_hash", params):
+                sha224.update("{}:{}\n".format(row[0], row[1]).encode("utf-8"))
+        h3.close()
+    ledger_check.close()
+    return sha224.hexdigest()
+
+
+def digests(pool, db, ranges):
+    return pool.map(segment_digest, [(db, start, end) for start, end in ranges], chunksize=1)
+
+
+def create_manifest(pool, db, last, size=SEGMENT):
+    """Returns the manifest of segment hashes of blocks 1..last-1 of a trusted ledger"""
+    ranges = segments(1, last, size)
+    return {'segment': size, 'last': last,
+            'segments': [[start, end, digest] for (start, end), digest in zip(ranges, digests(pool, db, ranges))]}
+
+
+def first_mismatch(pool, db, manifest):
+    """Returns the (start, end) of the first segment of db differing from the manifest, None if all match"""
+    ranges = [(start, end) for start, end, digest in manifest['segments']]
+    for (start, end), expected, found in zip(ranges, manifest['segments'], digests(pool, db, ranges)):
+        if expected[2] != found:
+            return start, end
+    return None
+
+
+def bisect_reference(pool, db, reference, start, end, parts):
+    """Narrows start..end-1 down to the first height whose rows differ from the reference ledger
+
+    Each round hashes parts sub-ranges in both ledgers at once, so the number of rounds
+    is the logarithm of the segment size in base parts.
+    """
+    while end - start > 1:
+        ranges = segments(start, end, max(1, -(-(end - start) // parts)))
+        local = digests(pool, db, ranges)
+        trusted = digests(pool, reference, ranges)
+        start, end = next((r for r, a, b in zip(ranges, local, trusted) if a != b), (start, start + 1))
+        print("Divergence between blocks {} and {}".format(start, end - 1))
+    return start
+
+
+def recompute_segment(db, start, end):
+    """Returns the first height of start..end-1 whose stored block hash does not recompute, None if there is none"""
+    with connect_readonly(db) as ledger_check:
+        h3 = ledger_check.cursor()
+        h3.execute("SELECT block_hash FROM transactions WHERE reward != 0 AND block_height < ? "
+                   "ORDER BY block_height DESC LIMIT 1", (start,))
+        result = h3.fetchone()
+        db_block_hash_prev = str(result[0]) if result else ""
+
+        for db_block_height, coinbase, transactions in iter_blocks(h3, start, end - 1):
+            if coinbase is None:
+                continue
+            db_block_hash = str(coinbase[7])
+            if db_block_height > 1 and not verify_block(db_block_height, transactions, db_block_hash,
+                                                        db_block_hash_prev):
+                return db_block_height
+            db_block_hash_prev = db_block_hash
+        h3.close()
+    ledger_check.close()
+    return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Locate the first block of a ledger differing from a trusted one')
+    parser.add_argument('--db', default='static/ledger.db', help='ledger to check (default static/ledger.db)')
+    parser.add_argument('--manifest', default='ledger_manifest.json',
+                        help='segment hashes of the trusted ledger (default ledger_manifest.json)')
+    parser.add_argument('--create', action='store_true',
+                        help='write the manifest of --db, which must be a trusted ledger, and exit')
+    parser.add_argument('--until', type=int, default=None,
+                        help='with --create, last height covered by the manifest (default the last block of --db)')
+    parser.add_argument('--segment', type=int, default=SEGMENT,
+                        help='with --create, blocks per segment (default {})'.format(SEGMENT))
+    parser.add_argument('--reference', default=None,
+                        help='trusted ledger used to locate the divergent height, and as manifest if there is none')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='number of worker processes hashing segments (default: number of cpus)')
+    args = parser.parse_args()
+
+    with multiprocessing.Pool(args.workers) as pool:
+        if args.create:
+            until = args.until
+            if until is None:
+                with connect_readonly(args.db) as ledger_check:
+                    until = ledger_check.execute("SELECT max(block_height) FROM transactions").fetchone()[0] or 0
+                ledger_check.close()
+            manifest = create_manifest(pool, args.db, until + 1, args.segment)
+            with open(args.manifest, 'w') as outfile:
+                json.dump(manifest, outfile)
+            print("Manifest of {} segments written to {}".format(len(manifest['segments']), args.manifest))
+            raise SystemExit(0)
+
+        try:
+            with open(args.manifest) as json_data:
+                manifest = json.load(json_data)
+        except FileNotFoundError:
+            if args.reference is None:
+                raise
+            print("No manifest found, hashing the segments of {}".format(args.reference))
+            with connect_readonly(args.reference) as ledger_check:
+                until = ledger_check.execute("SELECT max(block_height) FROM transactions").fetchone()[0] or 0
+            ledger_check.close()
+            manifest = create_manifest(pool, args.reference, until + 1)
+
+        print("---> Hashing {} segments of {}".format(len(manifest['segments']), args.db))
+        mismatch = first_mismatch(pool, args.db, manifest)
+        if mismatch is None:
+            print("All segments up to block {} match the manifest".format(manifest['last'] - 1))
+            raise SystemExit(0)
+
+        start, end = mismatch
+        print("---> First divergent segment: blocks {} to {}".format(start, end - 1))
+        if args.reference is not None:
+            height = bisect_reference(pool, args.db, args.reference, start, end, max(2, args.workers))
+            print("---> First divergent block: {}".format(height))
+        else:
+            height = recompute_segment(args.db, start, end)
+            if height is None:
+                print("---> All block hashes of the segment recompute, the stored hashes or mirror rows differ "
+                      "from the trusted ledger, use --reference to locate them")
+            else:
+                print("---> First block whose hash does not recompute: {}".format(height))
@@ -1,27 +1,359 @@
 """
 Run this script in the main ~/Bismuth folder
 If ledger is valid, data['valid'] = 'valid' in ledger.json
+A --sample spot check records its result in data['sample'] instead
 Log stored in verify.log
 """
 
+import os
+import sys
+import csv
 import sqlite3
-import base64
-import hashlib
 import time
+import math
 import json
+import argparse
+import multiprocessing
+from collections import deque
+import functools
+import random
 import log
 from quantizer import *
 from mining_heavy3 import *
 from Cryptodome.Hash import SHA
-from Cryptodome.PublicKey import RSA
-from Cryptodome.Signature import PKCS1_v1_5
-from polysign.signerfactory import SignerFactory
+from block_stream import iter_blocks, iter_diff_rows, iter_mirror_blocks
+from block_serializer import compute_block_hash
+from fixed_point import round_half_even, to_units, format_two, format_eight
+from verify_state import Checkpoint, load_tips, save_tips
+from sig_cache import SignatureCache, signature_digest
+from key_cache import VerifierCache
+import sig_dupes
+from verify_engine import Check, scan_ledger
+from verify_events import Progress, Mismatch, StageDone
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 POW_FORK = 854600
 HF2 = 1200000
 HF3 = 1450000
+HF4 = 4380000
+DIFF_START = 854660  # heavy3 difficulties are verified above this height
+RETARGET_START = POW_FORK - 1  # stored difficulties are recomputed from this height
+RETARGET_WINDOW = 1441  # timestamps of the previous blocks used by the retarget
+RETARGET_TOLERANCE = 1e-8
+REW_FORK = 800000
+DEV_ACC = "4edadac9093d9326ee4b17f869b14f1a2534f96f9c5d7b48dc9acaed"
+HN_ACC = "3e08b5538a4509d9daa99e01ca5912cda3e98a7f79ca01248c2bde16"
+REWARD_CHUNK = 100000  # mirror rows per chunk in verify_rewards_vectorized
+MINT_ADDRESSES = ("Development Reward", "Hypernode Payouts")  # senders of the mirror rows, never debited
+ALLOWED_DUPES = [708334, 708335]  # blocks allowed to repeat an earlier signature
+RANGE_STEP = 10000  # blocks per verification range
+STAGES = ('txs', 'blocks', 'diff', 'rewards', 'retarget')
+FORK_HEIGHTS = (POW_FORK, HF2, HF3, HF4)  # always part of a sample, with their neighbours
+
+# log messages of the stage events
+PROGRESS_MESSAGES = {'txs': "Bismuth transactions verified, block = {}",
+                     'blocks': "Bismuth blocks verified = {}",
+                     'diff': "Bismuth diffs verified = {}",
+                     'rewards': "Bismuth rewards verified = {}",
+                     'retarget': "Bismuth difficulty retargets verified = {}",
+                     'balances': "Bismuth balances replayed, block = {}"}
+STAGE_ENTRIES = {'txs': 'transactions', 'blocks': 'blocks', 'diff': 'diffs', 'rewards': 'rewards',
+                 'retarget': 'difficulty retargets', 'balances': 'balances'}
+
+# Known historical transactions whose signature check fails, keyed by block_height-timestamp
+TX_DB_HASHES = {
+    '27258-1493755375.23': 'acd6044591c5baf121e581225724fc13400941c7',
+    '27298-1493755830.58': '481ec856b50a5ae4f5b96de60a8eda75eccd2163',
+    '30440-1493768123.08': 'ed11b24530dbcc866ce9be773bfad14967a0e3eb',
+    '32127-1493775151.92': 'e594d04ad9e554bce63593b81f9444056dd1705d',
+    '32128-1493775170.17': '07a8c49d00e703f1e9518c7d6fa11d918d5a9036',
+    '37732-1493799037.60': '43c064309eff3b3f065414d7752f23e1de1e70cd',
+    '37898-1493799317.40': '2e85b5c4513f5e8f3c83a480aea02d9787496b7a',
+    '37898-1493799774.46': '4ea899b3bdd943a9f164265d51b9427f1316ce39',
+    '38083-1493800650.67': '65e93aab149c7e77e383e0f9eb1e7f9a021732a0',
+    '52233-1493876901.73': '29653fdefc6ca98aadeab37884383fedf9e031b3',
+    '52239-1493876963.71': '4c0e262de64a5e792601937a333ca2bf6d6681f2',
+    '52282-1493877169.29': '808f90534e7ba68ee60bb2ea4530f5ff7b9d8dea',
+    '52308-1493877257.85': '8919548fdbc5093a6e9320818a0ca058449e29c2',
+    '52393-1493877463.97': '0eba7623a44441d2535eafea4655e8ef524f3719',
+    '62507-1493946372.50': '81c9ca175d09f47497a57efeb51d16ee78ddc232',
+    '70094-1494032933.14': '2ca4403387e84b95ed558e7c9350c43efff8225c',
+    '107579-1495499385.55': '4c01d491b35583e6a880a016bd08ac992b25e946',
+    '109032-1495581934.71': 'e81caa48f4e04272b764bc58a0a68e07e44e50be',
+    '109032-1495581968.35': '26419351bc5cea781ac4b41c6a5ea757585ddbe4',
+    '109032-1495581997.74': 'ad634a23b69b6d5cf8514d6e3a5d8c7311240b58',
+    '109032-1495582052.39': '9a5815e1aaa50c129fad05d9502b2b83518ab0c6',
+    '109032-1495582073.80': 'c3ecbc412ed82539f866d5ce95a46df8f1bbc992',
+    '109032-1495582093.85': 'eff64357d0320c77c7774bdffbf0032bfbbcf40a',
+    '109032-1495582137.48': 'e3f34c3b0608a2276c3d179fe2091ae3b5b33458',
+    '109032-1495582167.81': 'dd9cf2436672c2b2b5a6cc230fe0bf548d3856c9',
+    '109032-1495582188.16': '978f7e42a98d00dd0b520fa330aec136976f2b10',
+    '109032-1495582212.49': '7991d2efed6c21509d104c4bb9a41db873a186bf',
+    '109032-1495582261.99': '496491a8243f92ef216b308a4b8e160f9ac8902f',
+    '109032-1495582281.92': 'c3eb75f099546cd1afec051194a4f0ce72808811',
+    '109032-1495582326.49': 'f6a2d15c18692c1507a2f0f31fb98ed126f6285d',
+    '109032-1495582345.66': 'c61b3073ae3345146589ef31a565874f3506aa3b',
+    '109032-1495582362.29': '91f0c2eb7c7d8badf279130f9d8810c31bca0738',
+    '109032-1495582391.27': '86ba22a36ad1604fcbeccb7b53a4f1878e42e7c8',
+    '109032-1495582414.48': '6c7fb968c6df05e6c41a2b57417265fcd21cf049',
+    '109032-1495582431.57': '85b846479fcf65e0b0407ae5a62a43e548a05b0f',
+    '109032-1495582452.90': 'be5985949a9f9c05e1087c373179f4699c9a285b',
+    '109032-1495582474.30': '5f8f33ccd3861dbaf3a9de679b2c57bb4dc6aa9e',
+    '109032-1495582491.33': 'bbca4c2cfb3b073dc26e2882a0c635b4f545c796',
+    '109032-1495582519.66': 'e8acaf4c324ad6380e95f05b5488507c1f677f0d',
+    '109032-1495582552.33': '1d19efbe74f1dcc0f3eecc97e57602a854cee80c',
+    '109032-1495582566.89': '6f855517a5a15764275b6b473df3d8b0424e14ca',
+    '109032-1495582578.06': '55d4af749af916a4af4190106133c4bd618fccd8',
+    '109032-1495582590.27': '312009efa7d8fbf3bd788704b9f4f9f4cca2bf6b',
+    '109032-1495582605.78': '92dd15a93e5fdc6d419e40e73c738618830778bf',
+    '109032-1495582629.72': 'c90a2baeeffb8283a781787af1b9a2d4e7390768',
+    '109032-1495582650.66': '76919616b3b26a13fbfccdb1f6a70478ecc99f5b',
+    '109032-1495582673.69': '8228a29ec46f4c017c983073e4bf52306d30a20e',
+    '109032-1495582692.76': 'd7f83c9cda72380748c9e697e864e64f371b0c87',
+    '109032-1495582705.82': 'd87f74eaa82d2566129d45f0040c6a796e6c00d6',
+    '109032-1495582718.75': '41e4b6595ecc0087b7a370c08b9e911ddf70621e',
+    '109032-1495582731.23': '11b95e7f210e616a39f1f3fc67055fed34d06d58',
+    '109032-1495582743.92': '118bcaf2a4064b64d1f48aaae2382ad9505027a4',
+    '109032-1495582756.92': '67a81e040ebf257024b56bf99de5763079d9c38b',
+    '109032-1495582768.07': '0afbcd111bedf61f67ee5eafc2e2792991254f33',
+    '109032-1495582780.58': 'd7351ae8a29e27327fc0952ce27405be487d4dcf',
+    '109032-1495582793.76': '56eca3202795443669b35af18c316a0bdc0166ab',
+    '109032-1495582810.24': '4841f3f01cd986863110fc9e61622c3598d7f6c4',
+    '109032-1495582823.22': '7a4244e0549fc2da9fa15328506f5afeb7fc36f4',
+    '109032-1495582833.89': '7af9fc46b2d70c5070737c0a1ecaccac11f420dd',
+    '109032-1495582860.55': 'eb8742ae1ec649e01b5ca5064da52b8be75a0be1',
+    '109034-1495582892.79': 'ef00516b9f723fe7eeed98465a2521f1d1910189',
+    '109034-1495582904.05': '56172b6625a163cd1e90e7676b33774b30dbe9a6',
+    '109034-1495582915.38': '90290d53ff8f16ffa9cf8ca5add1f155612dbefe',
+    '109035-1495582926.98': '8c5fc98e23948df56e9c05acc73e0f8f18df176e',
+    '109035-1495582943.53': '8c6ececc083b4fcadac2022f815407c685a7fcaf',
+    '109035-1495582976.65': '4cf4d45d0c98be3f1a8553f5ff2d183770ec1d27',
+    '109035-1495583322.14': '8d1c49a5c3e029a3c420a5361f3ed0ef629a3e91'
+}
+
+# Known historical blocks whose recomputed hash differs from the stored one
+BLOCK_DB_HASHES = {
+    8242: '4058bfeaca8280efcc19860b74ba4d1bd5c9eec4db468be5d14cb593',
+    9487: 'adaa3745034811028023456eeb374ea0204c7d9a142815be2ba7fc1d',
+    9786: '3cb4076ecde20c056675a75679aa8027d931ffd38b8d318c4013e660',
+    27258: 'c338d39b7d675e90db63c000e5dda6d3ecc5b3d1b38697dcf18c1725',
+    27298: 'c48e736aebdafe8483e1fff1bfd4771f1cdd387d4af51e5d6026e61c',
+    30440: '930c192d2959abc80428fa8b4f90a37661eb1d7c239dc4eaebfb7618',
+    32127: '2937783fb5b94b8381e4e5739b185222ad42b065b71a97cf295bc012',
+    32128: '9af754f33710644a2fb5a39737df74e45b17fa4f599abf7ebcdafe77',
+    37732: 'f8d6c049ed125b2c3cdf23fce024819f3066a7e0b77d542b32f35660',
+    37898: 'e436fcfb9c7eea5fcc99d352bcaf7091bf07494bbcee545025aac23d',
+    38083: '16af4205a2013739d3e4b9041d6fd58f1d289b2f90432e79271377d6',
+    52233: 'a34499741b13e18408f6203d57ea0c6142453a4f28752e3542365990',
+    52239: '7fad9c7ed488ee335337b1347de7545241dc18c9ebb315cedd72b72f',
+    52282: '888ace79c603a425193d5fa79ac3ad587061e9fe864248e2fc4985cf',
+    52308: '2c086d02ef5ceb92f18c1a0f539940d3c454927970867c551933d190',
+    52393: '714aa366139b9228a08fbf5605aa0863df883faaa5983b156e8378ad',
+    62507: '14c58afda4d3eb3046668074841a22456d370034efbd4b6e6ed8ace9',
+    70094: 'ca44701770895bd1ba8c2ae9fa131bb8ad8fb9d641fe1d0abb91c219',
+    116646: '1a630146349af911ce0348ed4d8d9ec5c47102377bcd92f4f9adcd2d',
+    117298: 'ee62adac24a3d42c4529645f070d15375810c2b0759fc1c9cd1ad62a',
+    126299: 'e2f91778fc41a72df269dba0be7a442149f6348d55863e7f7630818c',
+    126971: '3f6485e663e9895d98ca3f8319031ea4765dd4592a3da87d67c6bec2',
+    126981: '99030aec5a118b77620e137a2dc124ebc3daddc720143f74eb35727d',
+    127085: 'a852d76ad0125e71d6ef8ad552784c634b666937e1516c84d591d97e',
+    129904: '56c17469ffb83e83242b477058611d35fc8d850b8c43c131ad53e427',
+    129905: '963db019944acfb382be98d7506fa35ae93a6a0b86417c844eafbbaa',
+    130090: '4d3f9030d75243fc0ad4caa9eb91b56b46a369a83c85499b5ef0e3e3',
+    204434: '60be79e6fe9d97ee2089747cf87790c111625c6e2d32c3a6b3e61d09',
+    204453: 'f00b3c68b9fae7029f8ecf5cf16ffd7520e530bb0ceeeda6bfaa8953',
+    204456: '6e5659ae26742db5f8cc2fd51be099b61efcbb508c246b689c653148',
+    204503: '85aa4ee01a8ba849ee234a01b433ab40c1aeae52217eda577e683503',
+    204505: '5973c2d89210d29c38a01017a9255bb20c5ac526a7ada7f2739740ff',
+    204522: 'f17b834d272afbd49d0589c61c47cb712cc70192865d3f0b7167fc48',
+    204581: '46d79cd8a87ee6055792f1ed9a831cca8e91588255dde5f858e45732',
+    204649: '2facf1f742149e6633b1f30602fbec535c1000ef516b8e0df5e26f10',
+    204718: '1857df85b145acdf8b9344673ce21cc1100443371ef76751aa700192',
+    204790: '1b8ac8bc34d4b99d2339a99162411301f3066f45221ed033500036e0',
+    204860: '902ac47ae4f119bad7ffb66dfedd8bc435f1e63380f9c78c8bf4a5df',
+    204932: '25ebbd957028e05ef274498786ac7ad8ed5d11b33db817af16d1aa7d',
+    204999: '12fbcdfd7f72e4867e863ee1cd9013318246e9ea6ca6fa86e2bf1087',
+    205066: '1bf339b14ce8ec03ca3de0c08bd402975f65dccdc2474a2b11b63155',
+    205140: '1772a0c86920f257317d026a7378184a54f69e2816eb3e259e3f4295',
+    205157: 'c03529be3fc547c1ce08b366ee7efdd5091ce66a9b165a0a9b6eec94',
+    205205: 'eccc43513099ed05d0aac389a6ce1aeeb4188527da7d73e4a14db37e',
+    205274: '39b093a82b5d27639b917bf372fe7c99be59cb978fb4f3475e36c86a',
+    205275: '5fbb2c73f5e91bfb0bb8a608ec23f94643d897cd7d648fe49b46e2c5',
+    205344: 'd1085595cace93843212afc1adadb847bf25b2bea93f7ef177370ef2',
+    205415: 'e06f50ab329406ed087e412d100da41b3bf58cb770f20cd6168de4d6',
+    205487: '88ee8ad19e39ae30f7e1a0c5602da0bc6755575c25d2c43fc2fb9330',
+    205503: '6eefdcb8e58b8a7bbc2e613caaf44a1a6e23d8a9e684981e015aaaaf',
+    205556: 'c0961a54a1370c66a084ade2f00def65b8f89cfb21e793b7ae5c5b7c',
+    205629: '99d15ac4b631286a0fee858890c26ad14dad5417603f436e38531344',
+    205633: '3ec7fb7d18d3fe5c31d5510d08624d6fd4a4da0b5f6f991bc29c8370',
+    205704: '745a7233e326553c1bb4d6cc49f7f8476d17b836456adb28490d523a'
+}
+
+
+def height_ranges(first, last, step=RANGE_STEP):
+    """Split block heights first..last into contiguous (start, end) ranges of step blocks"""
+    return [(start, min(start + step - 1, last)) for start in range(first, last + 1, step)]
+
+
+def run_ranges(worker, db, ranges, workers, initializer=None):
+    """Runs worker on each height range, in a process pool if workers > 1, yields results in height order"""
+    jobs = [(db, start, end) for start, end in ranges]
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer) as pool:
+            for result in pool.imap(worker, jobs):
+                yield result
+    else:
+        if initializer is not None:
+            initializer()
+        for job in jobs:
+            yield worker(job)
+
+
+def connect_readonly(db):
+    """Read-only connection used by worker processes"""
+    ledger_check = sqlite3.connect("file:{}?mode=ro".format(db), uri=True)
+    ledger_check.text_factory = str
+    return ledger_check
+
+
+def block_anchor(ledger_check, height):
+    """Returns (timestamp, block_hash) stored for the last block at or below height"""
+    result = ledger_check.execute("SELECT timestamp, block_hash FROM transactions WHERE reward != 0 "
+                                  "AND block_height > 0 AND block_height <= ? ORDER BY block_height DESC LIMIT 1",
+                                  (height,)).fetchone()
+    if result is None:
+        return "", ""
+    return '%.2f' % quantize_two(result[0]), str(result[1])
+
+
+def resume_checkpoint(app_log, checkpoint, stage, ledger_check):
+    """Returns (height, invalid, done) saved for stage, (0, 0, False) to verify from genesis
+
+    The saved state is only used if the stored block hash at the checkpoint height is unchanged.
+    """
+    state = checkpoint.stage(stage) if checkpoint else None
+    if state is None:
+        return 0, 0, False
+
+    timestamp_prev, block_hash_prev = block_anchor(ledger_check, state['height'])
+    if block_hash_prev != state['block_hash_prev']:
+        app_log.warning("Ledger changed below the {} checkpoint at block {}, verifying from genesis"
+                        .format(stage, state['height']))
+        checkpoint.reset(stage)
+        return 0, 0, False
+
+    app_log.info("Resuming {} verification after block {}, {} invalid so far"
+                 .format(stage, state['height'], state['invalid']))
+    return state['height'], state['invalid'], state['done']
+
+
+def save_checkpoint(checkpoint, stage, ledger_check, height, invalid, done=False):
+    """Saves the progress of stage every checkpoint.every blocks, and when it is done"""
+    if checkpoint is None or not (done or checkpoint.due(stage, height)):
+        return
+    timestamp_prev, block_hash_prev = block_anchor(ledger_check, height)
+    checkpoint.update(stage, height, invalid, block_hash_prev, timestamp_prev, done)
+
+
+# Verified signature cache and parsed key cache of the current process, set up by init_txs_worker
+SIG_CACHE = None
+VERIFIERS = VerifierCache()
+
+
+def init_txs_worker(cache_file, key_cache_size):
+    global SIG_CACHE, VERIFIERS
+    # a cache file not created yet holds no verified signatures
+    SIG_CACHE = SignatureCache(cache_file, readonly=True) if cache_file and os.path.isfile(cache_file) else None
+    VERIFIERS = VerifierCache(key_cache_size)
+
+
+def verify_tx(row, verified):
+    """Returns True if the signature of a non-reward transaction row is valid or a known exception
+
+    With a signature cache, signatures found in it are not verified again and the digests
+    of newly verified ones are appended to verified.
+    """
+    db_block_height = str(row[0])
+    db_timestamp = format_two(row[1])
+    db_address = str(row[2])[:56]
+    db_recipient = str(row[3])[:56]
+    db_amount = format_eight(row[4])
+    db_signature_enc = str(row[5])[:684]
+    db_public_key_hashed = str(row[6])[:1068]
+    db_operation = str(row[10])[:30]
+    db_openfield = str(row[11])  # no limit for backward compatibility
+    buffer = str((db_timestamp, db_address, db_recipient, db_amount, db_operation, db_openfield)).encode("utf-8")
+
+    if SIG_CACHE is not None:
+        digest = signature_digest(db_signature_enc, db_public_key_hashed, buffer)
+        if digest in SIG_CACHE:
+            return True
+
+    try:
+        VERIFIERS.verify(db_signature_enc, db_public_key_hashed, buffer, db_address)
+    except Exception:
+        return SHA.new(buffer).hexdigest() == TX_DB_HASHES.get(db_block_height + "-" + db_timestamp)
+
+    if SIG_CACHE is not None:
+        verified.append(digest)
+    return True
+
+
+def verify_txs_range(args):
+    """Worker: verifies the transactions of blocks start..end
+
+    Returns the heights of invalid transactions, the digests of newly verified signatures
+    and the (hits, misses) of the key cache in this range.
+    """
+    db, start, end = args
+    failed = []
+    verified = []
+    hits, misses = VERIFIERS.hits, VERIFIERS.misses
+    with connect_readonly(db) as ledger_check:
+        h3 = ledger_check.cursor()
+        for row in h3.execute('SELECT * FROM transactions WHERE block_height >= ? AND block_height <= ? '
+                              'AND reward = 0 ORDER BY block_height', (start, end)):
+            if not verify_tx(row, verified):
+                failed.append(row[0])
+        h3.close()
+    ledger_check.close()
+    return start, end, failed, verified, (VERIFIERS.hits - hits, VERIFIERS.misses - misses)
+
+
+def progress(stage, height, first, last, started):
+    """Progress event of a stage started at time started from height first"""
+    elapsed = time.time() - started
+    return Progress(stage, height, last, (height - first + 1) / elapsed if elapsed > 0 else 0.0)
+
+
+def log_events(app_log, events):
+    """Logs the events of a verification stage, returns its invalid count"""
+    invalid = 0
+    for event in events:
+        if isinstance(event, Mismatch):
+            app_log.warning("{}: {}{}".format(event.reason, event.height, " " + event.detail if event.detail else ""))
+        elif isinstance(event, Progress):
+            app_log.info(PROGRESS_MESSAGES[event.stage].format(event.height))
+        elif isinstance(event, StageDone):
+            invalid = event.invalid
+            if invalid == 0:
+                app_log.info("All {} in the local ledger are valid".format(STAGE_ENTRIES[event.stage]))
+            else:
+                app_log.warning("{} invalid {} found".format(invalid, STAGE_ENTRIES[event.stage]))
+    return invalid
 
-def verify_txs(app_log, db, full_ledger):
+
+def verify_txs(app_log, db, full_ledger, workers=1, checkpoint=None, cache_file=None, key_cache_size=4096):
+    return log_events(app_log, iter_verify_txs(app_log, db, full_ledger, workers, checkpoint, cache_file,
+                                               key_cache_size))
+
+
+def iter_verify_txs(app_log, db, full_ledger, workers=1, checkpoint=None, cache_file=None, key_cache_size=4096):
+    """verify_txs as a generator of Progress, Mismatch and StageDone events"""
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
@@ -40,130 +372,92 @@ def verify_txs(app_log, db, full_ledger):
             genesis = result[1]
             app_log.info("Genesis: {}".format(genesis))
 
-        db_hashes = {
-            '27258-1493755375.23': 'acd6044591c5baf121e581225724fc13400941c7',
-            '27298-1493755830.58': '481ec856b50a5ae4f5b96de60a8eda75eccd2163',
-            '30440-1493768123.08': 'ed11b24530dbcc866ce9be773bfad14967a0e3eb',
-            '32127-1493775151.92': 'e594d04ad9e554bce63593b81f9444056dd1705d',
-            '32128-1493775170.17': '07a8c49d00e703f1e9518c7d6fa11d918d5a9036',
-            '37732-1493799037.60': '43c064309eff3b3f065414d7752f23e1de1e70cd',
-            '37898-1493799317.40': '2e85b5c4513f5e8f3c83a480aea02d9787496b7a',
-            '37898-1493799774.46': '4ea899b3bdd943a9f164265d51b9427f1316ce39',
-            '38083-1493800650.67': '65e93aab149c7e77e383e0f9eb1e7f9a021732a0',
-            '52233-1493876901.73': '29653fdefc6ca98aadeab37884383fedf9e031b3',
-            '52239-1493876963.71': '4c0e262de64a5e792601937a333ca2bf6d6681f2',
-            '52282-1493877169.29': '808f90534e7ba68ee60bb2ea4530f5ff7b9d8dea',
-            '52308-1493877257.85': '8919548fdbc5093a6e9320818a0ca058449e29c2',
-            '52393-1493877463.97': '0eba7623a44441d2535eafea4655e8ef524f3719',
-            '62507-1493946372.50': '81c9ca175d09f47497a57efeb51d16ee78ddc232',
-            '70094-1494032933.14': '2ca4403387e84b95ed558e7c9350c43efff8225c',
-            '107579-1495499385.55': '4c01d491b35583e6a880a016bd08ac992b25e946',
-            '109032-1495581934.71': 'e81caa48f4e04272b764bc58a0a68e07e44e50be',
-            '109032-1495581968.35': '26419351bc5cea781ac4b41c6a5ea757585ddbe4',
-            '109032-1495581997.74': 'ad634a23b69b6d5cf8514d6e3a5d8c7311240b58',
-            '109032-1495582052.39': '9a5815e1aaa50c129fad05d9502b2b83518ab0c6',
-            '109032-1495582073.80': 'c3ecbc412ed82539f866d5ce95a46df8f1bbc992',
-            '109032-1495582093.85': 'eff64357d0320c77c7774bdffbf0032bfbbcf40a',
-            '109032-1495582137.48': 'e3f34c3b0608a2276c3d179fe2091ae3b5b33458',
-            '109032-1495582167.81': 'dd9cf2436672c2b2b5a6cc230fe0bf548d3856c9',
-            '109032-1495582188.16': '978f7e42a98d00dd0b520fa330aec136976f2b10',
-            '109032-1495582212.49': '7991d2efed6c21509d104c4bb9a41db873a186bf',
-            '109032-1495582261.99': '496491a8243f92ef216b308a4b8e160f9ac8902f',
-            '109032-1495582281.92': 'c3eb75f099546cd1afec051194a4f0ce72808811',
-            '109032-1495582326.49': 'f6a2d15c18692c1507a2f0f31fb98ed126f6285d',
-            '109032-1495582345.66': 'c61b3073ae3345146589ef31a565874f3506aa3b',
-            '109032-1495582362.29': '91f0c2eb7c7d8badf279130f9d8810c31bca0738',
-            '109032-1495582391.27': '86ba22a36ad1604fcbeccb7b53a4f1878e42e7c8',
-            '109032-1495582414.48': '6c7fb968c6df05e6c41a2b57417265fcd21cf049',
-            '109032-1495582431.57': '85b846479fcf65e0b0407ae5a62a43e548a05b0f',
-            '109032-1495582452.90': 'be5985949a9f9c05e1087c373179f4699c9a285b',
-            '109032-1495582474.30': '5f8f33ccd3861dbaf3a9de679b2c57bb4dc6aa9e',
-            '109032-1495582491.33': 'bbca4c2cfb3b073dc26e2882a0c635b4f545c796',
-            '109032-1495582519.66': 'e8acaf4c324ad6380e95f05b5488507c1f677f0d',
-            '109032-1495582552.33': '1d19efbe74f1dcc0f3eecc97e57602a854cee80c',
-            '109032-1495582566.89': '6f855517a5a15764275b6b473df3d8b0424e14ca',
-            '109032-1495582578.06': '55d4af749af916a4af4190106133c4bd618fccd8',
-            '109032-1495582590.27': '312009efa7d8fbf3bd788704b9f4f9f4cca2bf6b',
-            '109032-1495582605.78': '92dd15a93e5fdc6d419e40e73c738618830778bf',
-            '109032-1495582629.72': 'c90a2baeeffb8283a781787af1b9a2d4e7390768',
-            '109032-1495582650.66': '76919616b3b26a13fbfccdb1f6a70478ecc99f5b',
-            '109032-1495582673.69': '8228a29ec46f4c017c983073e4bf52306d30a20e',
-            '109032-1495582692.76': 'd7f83c9cda72380748c9e697e864e64f371b0c87',
-            '109032-1495582705.82': 'd87f74eaa82d2566129d45f0040c6a796e6c00d6',
-            '109032-1495582718.75': '41e4b6595ecc0087b7a370c08b9e911ddf70621e',
-            '109032-1495582731.23': '11b95e7f210e616a39f1f3fc67055fed34d06d58',
-            '109032-1495582743.92': '118bcaf2a4064b64d1f48aaae2382ad9505027a4',
-            '109032-1495582756.92': '67a81e040ebf257024b56bf99de5763079d9c38b',
-            '109032-1495582768.07': '0afbcd111bedf61f67ee5eafc2e2792991254f33',
-            '109032-1495582780.58': 'd7351ae8a29e27327fc0952ce27405be487d4dcf',
-            '109032-1495582793.76': '56eca3202795443669b35af18c316a0bdc0166ab',
-            '109032-1495582810.24': '4841f3f01cd986863110fc9e61622c3598d7f6c4',
-            '109032-1495582823.22': '7a4244e0549fc2da9fa15328506f5afeb7fc36f4',
-            '109032-1495582833.89': '7af9fc46b2d70c5070737c0a1ecaccac11f420dd',
-            '109032-1495582860.55': 'eb8742ae1ec649e01b5ca5064da52b8be75a0be1',
-            '109034-1495582892.79': 'ef00516b9f723fe7eeed98465a2521f1d1910189',
-            '109034-1495582904.05': '56172b6625a163cd1e90e7676b33774b30dbe9a6',
-            '109034-1495582915.38': '90290d53ff8f16ffa9cf8ca5add1f155612dbefe',
-            '109035-1495582926.98': '8c5fc98e23948df56e9c05acc73e0f8f18df176e',
-            '109035-1495582943.53': '8c6ececc083b4fcadac2022f815407c685a7fcaf',
-            '109035-1495582976.65': '4cf4d45d0c98be3f1a8553f5ff2d183770ec1d27',
-            '109035-1495583322.14': '8d1c49a5c3e029a3c420a5361f3ed0ef629a3e91'
-        }
-
-        print_step = 10000
-        invalid = 0
-        for row in h3.execute('SELECT * FROM transactions WHERE block_height > 0 and reward = 0 ORDER BY block_height'):
-
-            db_block_height = str(row[0])
-            db_timestamp = '%.2f' % (quantize_two(row[1]))
-            db_address = str(row[2])[:56]
-            db_recipient = str(row[3])[:56]
-            db_amount = '%.8f' % (quantize_eight(row[4]))
-            db_signature_enc = str(row[5])[:684]
-            db_public_key_hashed = str(row[6])[:1068]
-            db_operation = str(row[10])[:30]
-            db_openfield = str(row[11])  # no limit for backward compatibility
-            buffer = str((db_timestamp, db_address, db_recipient, db_amount, db_operation, db_openfield)).encode("utf-8")
-
-            try:
-                SignerFactory.verify_bis_signature(db_signature_enc, db_public_key_hashed, buffer, db_address)
-            except Exception as e:
-                hash = SHA.new(buffer)
-                try:
-                    if hash.hexdigest() != db_hashes[db_block_height + "-" + db_timestamp]:
-                        app_log.warning("Signature validation problem: {}".format(db_block_height))
-                        invalid = invalid + 1
-                except Exception as e:
-                    app_log.warning("Signature validation problem: {}".format(db_block_height))
-                    invalid = invalid + 1
-
-            if int(db_block_height) > print_step:
-                app_log.info("Bismuth transactions verified, block = {}".format(print_step))
-                print_step += 10000
-
-        if invalid == 0:
-            app_log.info("All transactions in the local ledger are valid")
-        else:
-            app_log.warning("{} invalid transactions found".format(invalid))
+        height, invalid, done = resume_checkpoint(app_log, checkpoint, 'txs', ledger_check)
+        h3.execute("SELECT max(block_height) FROM transactions")
+        last = h3.fetchone()[0] or 0
+        ranges = [] if done else height_ranges(height + 1, last)
+        started = time.time()
+        cache = SignatureCache(cache_file) if cache_file else None
+        cached = 0
+        key_hits = key_misses = 0
+        for start, end, failed, verified, key_stats in run_ranges(
+                verify_txs_range, db, ranges, workers,
+                functools.partial(init_txs_worker, cache_file, key_cache_size)):
+            for db_block_height in failed:
+                yield Mismatch('txs', db_block_height, "Signature validation problem", "")
+            invalid = invalid + len(failed)
+            if cache is not None:
+                cache.add(verified)
+                cached = cached + len(verified)
+            key_hits = key_hits + key_stats[0]
+            key_misses = key_misses + key_stats[1]
+            save_checkpoint(checkpoint, 'txs', ledger_check, end, invalid)
+            yield progress('txs', end, height + 1, last, started)
+        save_checkpoint(checkpoint, 'txs', ledger_check, last, invalid, done=True)
+        app_log.info("Public key cache: {} hits, {} misses, size {} per worker"
+                     .format(key_hits, key_misses, key_cache_size))
+        if cache is not None:
+            app_log.info("{} signatures added to the cache, {} cached".format(cached, len(cache)))
+            cache.close()
 
         h3.close()
+        yield StageDone('txs', last, invalid)
 
     except Exception as e:
         app_log.error("Error: {}".format(e))
         raise
 
-    return invalid
-
 
 def bin_convert(string):
     return ''.join(format(ord(x), '8b').replace(' ', '0') for x in string)
 
 
-def verify_blocks(app_log, db):
+def verify_block(db_block_height, transactions, db_block_hash, db_block_hash_prev):
+    """Returns True if the block hash recomputed from the transaction rows matches the stored one"""
+    block_hash = compute_block_hash(transactions, db_block_hash_prev)
+    return block_hash == db_block_hash or block_hash == BLOCK_DB_HASHES.get(db_block_height)
+
+
+def verify_blocks_range(args):
+    """Worker: verifies the hashes of blocks start..end, returns the heights of invalid ones
+
+    Each block hash chains on the stored hash of the previous block, so the range is seeded
+    with the stored hash of the last block below start and does not depend on other ranges.
+    """
+    db, start, end = args
+    failed = []
+    with connect_readonly(db) as ledger_check:
+        h3 = ledger_check.cursor()
+
+        h3.execute("SELECT block_hash FROM transactions WHERE reward != 0 AND block_height < ? "
+                   "ORDER BY block_height DESC LIMIT 1", (start,))
+        result = h3.fetchone()
+        db_block_hash_prev = str(result[0]) if result else ""
+
+        for db_block_height, coinbase, transactions in iter_blocks(h3, start, end):
+            if coinbase is None:
+                continue
+            db_block_hash = str(coinbase[7])
+            if db_block_height > 1:
+                if not verify_block(db_block_height, transactions, db_block_hash, db_block_hash_prev):
+                    failed.append(db_block_height)
+
+            db_block_hash_prev = db_block_hash
+
+        h3.close()
+    ledger_check.close()
+    return start, end, failed
+
+
+def verify_blocks(app_log, db, workers=1, checkpoint=None):
+    return log_events(app_log, iter_verify_blocks(app_log, db, workers, checkpoint))
+
+
+def iter_verify_blocks(app_log, db, workers=1, checkpoint=None):
+    """verify_blocks as a generator of Progress, Mismatch and StageDone events"""
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
-        h4 = ledger_check.cursor()
 
     try:
         app_log.info("Verification of blocks started...")
@@ -172,122 +466,34 @@ def verify_blocks(app_log, db):
         db_rows = h3.fetchone()[0]
         app_log.info("Number of blocks: {}".format(db_rows))
 
-        db_hashes = {
-            8242: '4058bfeaca8280efcc19860b74ba4d1bd5c9eec4db468be5d14cb593',
-            9487: 'adaa3745034811028023456eeb374ea0204c7d9a142815be2ba7fc1d',
-            9786: '3cb4076ecde20c056675a75679aa8027d931ffd38b8d318c4013e660',
-            27258: 'c338d39b7d675e90db63c000e5dda6d3ecc5b3d1b38697dcf18c1725',
-            27298: 'c48e736aebdafe8483e1fff1bfd4771f1cdd387d4af51e5d6026e61c',
-            30440: '930c192d2959abc80428fa8b4f90a37661eb1d7c239dc4eaebfb7618',
-            32127: '2937783fb5b94b8381e4e5739b185222ad42b065b71a97cf295bc012',
-            32128: '9af754f33710644a2fb5a39737df74e45b17fa4f599abf7ebcdafe77',
-            37732: 'f8d6c049ed125b2c3cdf23fce024819f3066a7e0b77d542b32f35660',
-            37898: 'e436fcfb9c7eea5fcc99d352bcaf7091bf07494bbcee545025aac23d',
-            38083: '16af4205a2013739d3e4b9041d6fd58f1d289b2f90432e79271377d6',
-            52233: 'a34499741b13e18408f6203d57ea0c6142453a4f28752e3542365990',
-            52239: '7fad9c7ed488ee335337b1347de7545241dc18c9ebb315cedd72b72f',
-            52282: '888ace79c603a425193d5fa79ac3ad587061e9fe864248e2fc4985cf',
-            52308: '2c086d02ef5ceb92f18c1a0f539940d3c454927970867c551933d190',
-            52393: '714aa366139b9228a08fbf5605aa0863df883faaa5983b156e8378ad',
-            62507: '14c58afda4d3eb3046668074841a22456d370034efbd4b6e6ed8ace9',
-            70094: 'ca44701770895bd1ba8c2ae9fa131bb8ad8fb9d641fe1d0abb91c219',
-            116646: '1a630146349af911ce0348ed4d8d9ec5c47102377bcd92f4f9adcd2d',
-            117298: 'ee62adac24a3d42c4529645f070d15375810c2b0759fc1c9cd1ad62a',
-            126299: 'e2f91778fc41a72df269dba0be7a442149f6348d55863e7f7630818c',
-            126971: '3f6485e663e9895d98ca3f8319031ea4765dd4592a3da87d67c6bec2',
-            126981: '99030aec5a118b77620e137a2dc124ebc3daddc720143f74eb35727d',
-            127085: 'a852d76ad0125e71d6ef8ad552784c634b666937e1516c84d591d97e',
-            129904: '56c17469ffb83e83242b477058611d35fc8d850b8c43c131ad53e427',
-            129905: '963db019944acfb382be98d7506fa35ae93a6a0b86417c844eafbbaa',
-            130090: '4d3f9030d75243fc0ad4caa9eb91b56b46a369a83c85499b5ef0e3e3',
-            204434: '60be79e6fe9d97ee2089747cf87790c111625c6e2d32c3a6b3e61d09',
-            204453: 'f00b3c68b9fae7029f8ecf5cf16ffd7520e530bb0ceeeda6bfaa8953',
-            204456: '6e5659ae26742db5f8cc2fd51be099b61efcbb508c246b689c653148',
-            204503: '85aa4ee01a8ba849ee234a01b433ab40c1aeae52217eda577e683503',
-            204505: '5973c2d89210d29c38a01017a9255bb20c5ac526a7ada7f2739740ff',
-            204522: 'f17b834d272afbd49d0589c61c47cb712cc70192865d3f0b7167fc48',
-            204581: '46d79cd8a87ee6055792f1ed9a831cca8e91588255dde5f858e45732',
-            204649: '2facf1f742149e6633b1f30602fbec535c1000ef516b8e0df5e26f10',
-            204718: '1857df85b145acdf8b9344673ce21cc1100443371ef76751aa700192',
-            204790: '1b8ac8bc34d4b99d2339a99162411301f3066f45221ed033500036e0',
-            204860: '902ac47ae4f119bad7ffb66dfedd8bc435f1e63380f9c78c8bf4a5df',
-            204932: '25ebbd957028e05ef274498786ac7ad8ed5d11b33db817af16d1aa7d',
-            204999: '12fbcdfd7f72e4867e863ee1cd9013318246e9ea6ca6fa86e2bf1087',
-            205066: '1bf339b14ce8ec03ca3de0c08bd402975f65dccdc2474a2b11b63155',
-            205140: '1772a0c86920f257317d026a7378184a54f69e2816eb3e259e3f4295',
-            205157: 'c03529be3fc547c1ce08b366ee7efdd5091ce66a9b165a0a9b6eec94',
-            205205: 'eccc43513099ed05d0aac389a6ce1aeeb4188527da7d73e4a14db37e',
-            205274: '39b093a82b5d27639b917bf372fe7c99be59cb978fb4f3475e36c86a',
-            205275: '5fbb2c73f5e91bfb0bb8a608ec23f94643d897cd7d648fe49b46e2c5',
-            205344: 'd1085595cace93843212afc1adadb847bf25b2bea93f7ef177370ef2',
-            205415: 'e06f50ab329406ed087e412d100da41b3bf58cb770f20cd6168de4d6',
-            205487: '88ee8ad19e39ae30f7e1a0c5602da0bc6755575c25d2c43fc2fb9330',
-            205503: '6eefdcb8e58b8a7bbc2e613caaf44a1a6e23d8a9e684981e015aaaaf',
-            205556: 'c0961a54a1370c66a084ade2f00def65b8f89cfb21e793b7ae5c5b7c',
-            205629: '99d15ac4b631286a0fee858890c26ad14dad5417603f436e38531344',
-            205633: '3ec7fb7d18d3fe5c31d5510d08624d6fd4a4da0b5f6f991bc29c8370',
-            205704: '745a7233e326553c1bb4d6cc49f7f8476d17b836456adb28490d523a'
-        }
-
-        print_step = 10000
-        invalid = 0
-        db_block_hash_prev = ""
-        for row in h3.execute('SELECT * FROM transactions WHERE reward != 0 ORDER BY block_height'):
-            db_block_height = row[0]
-            db_block_hash = str(row[7])
-            if db_block_height > 1:
-                transaction_list_converted = []
-                for transaction in h4.execute('SELECT * FROM transactions WHERE block_height={}'
-                                              .format(db_block_height)):
-                    q_received_timestamp = quantize_two(transaction[1])
-                    received_timestamp = '%.2f' % q_received_timestamp
-                    received_address = str(transaction[2])[:56]
-                    received_recipient = str(transaction[3])[:56]
-                    received_amount = '%.8f' % (quantize_eight(transaction[4]))
-                    received_signature_enc = str(transaction[5])[:684]
-                    received_public_key_hashed = str(transaction[6])[:1068]
-                    received_operation = str(transaction[10])
-                    received_openfield = str(transaction[11])
-
-                    transaction_list_converted.append((received_timestamp, received_address, received_recipient,
-                                                      received_amount, received_signature_enc,
-                                                      received_public_key_hashed, received_operation,
-                                                      received_openfield))
-
-                block_hash = hashlib.sha224((str(transaction_list_converted) + db_block_hash_prev).encode("utf-8"))\
-                    .hexdigest()
-                if block_hash != db_block_hash:
-                    try:
-                        if block_hash != db_hashes[db_block_height]:
-                            app_log.warning("Block hash mismatch: {}".format(db_block_height))
-                            invalid = invalid + 1
-                    except Exception as e:
-                        app_log.warning("Block hash mismatch: {} {}".format(db_block_height, e))
-                        invalid = invalid + 1
-
-            db_block_hash_prev = db_block_hash
-
-            if db_block_height > print_step:
-                app_log.info("Bismuth blocks verified = {}".format(print_step))
-                print_step += 10000
-
-        if invalid == 0:
-            app_log.info("All blocks in the local ledger are valid")
-        else:
-            app_log.warning("{} invalid blocks found".format(invalid))
+        height, invalid, done = resume_checkpoint(app_log, checkpoint, 'blocks', ledger_check)
+        h3.execute("SELECT min(block_height), max(block_height) FROM transactions WHERE reward != 0")
+        first, last = h3.fetchone()
+        first, last = max(first or 0, height + 1), last or 0
+        ranges = [] if done else height_ranges(first, last)
+        started = time.time()
+        for start, end, failed in run_ranges(verify_blocks_range, db, ranges, workers):
+            for db_block_height in failed:
+                yield Mismatch('blocks', db_block_height, "Block hash mismatch", "")
+            invalid = invalid + len(failed)
+            save_checkpoint(checkpoint, 'blocks', ledger_check, end, invalid)
+            yield progress('blocks', end, first, last, started)
+        save_checkpoint(checkpoint, 'blocks', ledger_check, last, invalid, done=True)
 
         h3.close()
-        h4.close()
+        yield StageDone('blocks', last, invalid)
 
     except Exception as e:
         app_log.info("Error: {}".format(e))
         raise
 
-    return invalid
 
+def check_block(block_height_new, miner_address, nonce, db_block_hash, diff0, timestamp, timestamp_last):
+    """Returns True if the block meets diff0 or the dropped difficulty
 
-def check_block(block_height_new, miner_address, nonce, db_block_hash, diff0,
-                received_timestamp, q_received_timestamp, q_db_timestamp_last):
+    timestamp and timestamp_last are in centiseconds, the dropped difficulty is computed
+    in units of 1e-10 with the rounding of quantize_ten.
+    """
     if block_height_new == POW_FORK - 1:
         diff0 = FORK_DIFF
     if block_height_new == POW_FORK:
@@ -295,167 +501,829 @@ def check_block(block_height_new, miner_address, nonce, db_block_hash, diff0,
 
     bok = False
     real_diff = diffme_heavy3(miner_address, nonce, db_block_hash)
-    diff_drop_time = Decimal(180)
+    diff_drop_time = 18000  # 180 s
     if real_diff >= int(diff0):
         bok = True
 
-    elif Decimal(received_timestamp) > q_db_timestamp_last + Decimal(diff_drop_time):
+    elif timestamp > timestamp_last + diff_drop_time:
         # uses block timestamp, don't merge with diff() for security reasons
-        time_difference = q_received_timestamp - q_db_timestamp_last
-        diff_dropped = quantize_ten(diff0) + quantize_ten(1) - quantize_ten(time_difference / diff_drop_time)
+        time_difference = timestamp - timestamp_last
+        diff_dropped = to_units(diff0, 10) + to_units(1, 10) - \
+            round_half_even(time_difference * 10 ** 10, diff_drop_time)
         # Emergency diff drop
-        if Decimal(received_timestamp) > q_db_timestamp_last + Decimal(2 * diff_drop_time):
+        if timestamp > timestamp_last + 2 * diff_drop_time:
             factor = 10
-            diff_dropped = quantize_ten(diff0) - quantize_ten(1) - \
-                quantize_ten(factor * (time_difference - 2 * diff_drop_time) / diff_drop_time)
+            diff_dropped = to_units(diff0, 10) - to_units(1, 10) - \
+                round_half_even(factor * (time_difference - 2 * diff_drop_time) * 10 ** 10, diff_drop_time)
 
-        if diff_dropped < 50:
-            diff_dropped = 50
-        if real_diff >= int(diff_dropped):
+        if diff_dropped < to_units(50, 10):
+            diff_dropped = to_units(50, 10)
+        if real_diff >= diff_dropped // 10 ** 10:
             bok = True
 
     return bok
 
 
-def verify_diff(app_log, db):
-    with sqlite3.connect(db) as ledger_check:
-        ledger_check.text_factory = str
+def verify_diff_range(args):
+    """Worker: verifies the heavy3 difficulty of blocks start..end, returns the heights of invalid ones
+
+    The range is seeded with the stored hash and timestamp of the block before start,
+    so the diff drop logic of check_block sees the same values as in a serial pass.
+    """
+    db, start, end = args
+    failed = []
+    with connect_readonly(db) as ledger_check:
         h3 = ledger_check.cursor()
-        h4 = ledger_check.cursor()
 
-    try:
-        app_log.info("Verification of diffs started...")
-        mining_open()
-        # verify blockchain
-        print_step = 854000
-        invalid = 0
-        db_block_hash_prev = ""
-        db_timestamp_prev = ""
+        h3.execute("SELECT transactions.timestamp, transactions.block_hash FROM misc "
+                   "JOIN transactions ON transactions.block_height = misc.block_height "
+                   "WHERE misc.block_height > ? AND misc.block_height < ? AND transactions.reward != 0 "
+                   "ORDER BY misc.block_height DESC LIMIT 1", (DIFF_START, start))
+        result = h3.fetchone()
+        db_timestamp_prev = to_units(result[0], 2) if result else 0
+        db_block_hash_prev = str(result[1]) if result else ""
 
-        for row in h3.execute('SELECT * FROM misc where block_height>854660 ORDER BY block_height'):
+        for row in iter_diff_rows(h3, start - 1, end):
             db_block_height = row[0]
             db_diff = int(float(row[1]))
-
-            h4.execute("SELECT * FROM transactions WHERE block_height = {} and reward != 0".format(db_block_height))
-            result = h4.fetchall()[0]
-            db_timestamp = quantize_two(result[1])
-            miner_address = str(result[2])
-            db_block_hash = str(result[7])
-            db_nonce = str(result[11])
+            db_timestamp = to_units(row[2], 2)
+            miner_address = str(row[3])
+            db_block_hash = str(row[4])
+            db_nonce = str(row[5])
 
             if len(db_block_hash_prev) > 1:
                 bok = check_block(db_block_height, miner_address, db_nonce, db_block_hash_prev, db_diff, db_timestamp,
-                                  db_timestamp, db_timestamp_prev)
+                                  db_timestamp_prev)
 
                 if not bok:
-                    app_log.warning("Diff mismatch: {}".format(db_block_height))
-                    invalid = invalid + 1
-
-            if db_block_height > print_step:
-                app_log.info("Bismuth diffs verified = {}".format(print_step))
-                print_step += 10000
+                    failed.append(db_block_height)
 
             db_block_hash_prev = db_block_hash
             db_timestamp_prev = db_timestamp
 
-        if invalid == 0:
-            app_log.info("All diffs in the local ledger are valid")
-        else:
-            app_log.warning("{} invalid diffs found".format(invalid))
+        h3.close()
+    ledger_check.close()
+    return start, end, failed
+
+
+def verify_diff(app_log, db, workers=1, checkpoint=None):
+    """Verifies the heavy3 difficulty of all blocks since DIFF_START
+
+    mining_open() runs once before the workers start, so heavy3a.bin is created at most once.
+    It memory-maps the file as a shared mapping, which forked workers inherit: they share the
+    page cache of the file instead of holding a copy each.
+    """
+    return log_events(app_log, iter_verify_diff(app_log, db, workers, checkpoint))
+
+
+def iter_verify_diff(app_log, db, workers=1, checkpoint=None):
+    """verify_diff as a generator of Progress, Mismatch and StageDone events"""
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+
+    try:
+        app_log.info("Verification of diffs started...")
+        height, invalid, done = resume_checkpoint(app_log, checkpoint, 'diff', ledger_check)
+        h3.execute("SELECT max(block_height) FROM misc")
+        last = h3.fetchone()[0] or 0
+        first = max(DIFF_START, height) + 1
+        ranges = [] if done else height_ranges(first, last)
+        initializer = None
+        if ranges:
+            mining_open()
+            # workers that are not forked map the file again, it exists by now
+            initializer = None if multiprocessing.get_start_method() == 'fork' else mining_open
+        started = time.time()
+        for start, end, failed in run_ranges(verify_diff_range, db, ranges, workers, initializer):
+            for db_block_height in failed:
+                yield Mismatch('diff', db_block_height, "Diff mismatch", "")
+            invalid = invalid + len(failed)
+            save_checkpoint(checkpoint, 'diff', ledger_check, end, invalid)
+            yield progress('diff', end, first, last, started)
+        save_checkpoint(checkpoint, 'diff', ledger_check, last, invalid, done=True)
 
         h3.close()
-        h4.close()
+        yield StageDone('diff', last, invalid)
 
     except Exception as e:
         app_log.info("Error: {}".format(e))
         raise
 
-    return invalid
 
+def retarget_difficulty(timestamps, diff_block_previous):
+    """Difficulty of the next block computed like difficulty() of the node
+
+    timestamps are the timestamps of the last RETARGET_WINDOW blocks, oldest first,
+    diff_block_previous the stored difficulty of the last block. Returns the value stored in misc.
+    """
+    timestamp_last = Decimal(timestamps[-1])
+    timestamp_before_last = Decimal(timestamps[-2])
+    timestamp_1441 = Decimal(timestamps[0])
+    timestamp_1440 = Decimal(timestamps[1])
+    block_time_prev = (timestamp_before_last - timestamp_1441) / 1440
+    block_time = Decimal(timestamp_last - timestamp_1440) / 1440
+    diff_block_previous = Decimal(diff_block_previous)
+
+    hashrate = pow(2, diff_block_previous / Decimal(2.0)) / (
+        block_time * math.ceil(28 - diff_block_previous / Decimal(16.0)))
+    # Calculate new difficulty for desired blocktime of 60 seconds
+    target = Decimal(60.00)
+    difficulty_new = Decimal(
+        (2 / math.log(2)) * math.log(hashrate * target * math.ceil(28 - diff_block_previous / Decimal(16.0))))
+    # Feedback controller
+    Kd = 10
+    difficulty_new = difficulty_new - Kd * (block_time - block_time_prev)
+    diff_adjustment = (difficulty_new - diff_block_previous) / 720  # reduce by factor of 720
+
+    if diff_adjustment > Decimal(1.0):
+        diff_adjustment = Decimal(1.0)
+
+    difficulty = quantize_ten(diff_block_previous + diff_adjustment)
+    if difficulty < 50:
+        difficulty = 50
+    return float('%.10f' % difficulty)
+
+
+def verify_retarget_range(args, tolerance=RETARGET_TOLERANCE):
+    """Worker: recomputes the stored difficulty of blocks start..end, returns (height, stored, expected) of invalid ones
+
+    The timestamps of the last RETARGET_WINDOW blocks are kept in a ring buffer, filled from the
+    blocks before start, so the range needs one sequential scan of misc and no query per block.
+    """
+    db, start, end = args
+    failed = []
+    window = deque(maxlen=RETARGET_WINDOW)
+    diff_block_previous = None
+    last_height = None
+    with connect_readonly(db) as ledger_check:
+        h3 = ledger_check.cursor()
+        for row in iter_diff_rows(h3, start - RETARGET_WINDOW - 1, end):
+            db_block_height = row[0]
+            db_difficulty = float(row[1])
+            if last_height is not None and db_block_height != last_height + 1:
+                window.clear()  # missing block, the window restarts after it
+
+            if db_block_height >= start and len(window) == RETARGET_WINDOW:
+                if db_block_height in (POW_FORK - 1, POW_FORK):
+                    expected = FORK_DIFF
+                else:
+                    expected = retarget_difficulty(window, diff_block_previous)
+                if abs(db_difficulty - expected) > tolerance:
+                    failed.append((db_block_height, db_difficulty, expected))
+
+            window.append(row[2])
+            diff_block_previous = row[1]
+            last_height = db_block_height
+        h3.close()
+    ledger_check.close()
+    return start, end, failed
+
+
+def verify_retarget(app_log, db, workers=1, checkpoint=None, tolerance=RETARGET_TOLERANCE):
+    """Verifies that the stored difficulty of every block since RETARGET_START follows the retarget rules"""
+    return log_events(app_log, iter_verify_retarget(app_log, db, workers, checkpoint, tolerance))
 
-def verify_rewards(app_log, db):
+
+def iter_verify_retarget(app_log, db, workers=1, checkpoint=None, tolerance=RETARGET_TOLERANCE):
+    """verify_retarget as a generator of Progress, Mismatch and StageDone events"""
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
 
-    dev_acc = "4edadac9093d9326ee4b17f869b14f1a2534f96f9c5d7b48dc9acaed"
-    hn_acc = "3e08b5538a4509d9daa99e01ca5912cda3e98a7f79ca01248c2bde16"
-    rew_fork = 800000
+    try:
+        app_log.info("Verification of difficulty retargets started...")
+        height, invalid, done = resume_checkpoint(app_log, checkpoint, 'retarget', ledger_check)
+        h3.execute("SELECT max(block_height) FROM misc")
+        last = h3.fetchone()[0] or 0
+        first = max(RETARGET_START, height + 1)
+        ranges = [] if done else height_ranges(first, last)
+        started = time.time()
+        for start, end, failed in run_ranges(functools.partial(verify_retarget_range, tolerance=tolerance), db,
+                                             ranges, workers):
+            for db_block_height, stored, expected in failed:
+                yield Mismatch('retarget', db_block_height, "Difficulty retarget mismatch",
+                               "{} {}".format(stored, expected))
+            invalid = invalid + len(failed)
+            save_checkpoint(checkpoint, 'retarget', ledger_check, end, invalid)
+            yield progress('retarget', end, first, last, started)
+        save_checkpoint(checkpoint, 'retarget', ledger_check, last, invalid, done=True)
+
+        h3.close()
+        yield StageDone('retarget', last, invalid)
+
+    except Exception as e:
+        app_log.info("Error: {}".format(e))
+        raise
+
+
+def apply_rows(balances, transactions, debit=True):
+    """Applies transaction rows to balances in units of 1e-8 BIS, returns the set of debited addresses
+
+    The recipient is credited with amount and reward, the sender is debited with amount and fee.
+    """
+    debited = set()
+    for row in transactions:
+        amount = to_units(row[4], 8)
+        recipient = sys.intern(str(row[3]))
+        balances[recipient] = balances.get(recipient, 0) + amount + to_units(row[9], 8)
+        address = str(row[2])
+        if debit and address not in MINT_ADDRESSES:
+            address = sys.intern(address)
+            balances[address] = balances.get(address, 0) - amount - to_units(row[8], 8)
+            debited.add(address)
+    return debited
+
+
+def write_balances(balances, filename):
+    """Writes the balance table as csv, address and balance in BIS"""
+    with open(filename, 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(('address', 'balance'))
+        for address in sorted(balances):
+            writer.writerow((address, '{:.8f}'.format(Decimal(balances[address]).scaleb(-8))))
+
+
+def verify_balances(app_log, db, balance_table=None):
+    """Verifies that no address ever spends more than its balance"""
+    return log_events(app_log, iter_verify_balances(app_log, db, balance_table))
+
+
+def iter_verify_balances(app_log, db, balance_table=None):
+    """verify_balances as a generator of Progress, Mismatch and StageDone events
+
+    Blocks and the mirror rows of the same absolute height are replayed in one pass, integer balances
+    are kept per address. An address debited in a block must not have a negative balance at its end.
+    Memory grows with the number of addresses only. The final balances can be written to balance_table.
+    """
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+        h4 = ledger_check.cursor()
 
     try:
-        app_log.info("Verification of rewards started...")
-        print_step = 50000
+        app_log.info("Verification of balances started...")
+        h3.execute("SELECT max(block_height) FROM transactions")
+        last = h3.fetchone()[0] or 0
+        balances = {}
         invalid = 0
+        print_step = RANGE_STEP
+        started = time.time()
+        mirror_blocks = iter_mirror_blocks(h4)
+        mirror = next(mirror_blocks, None)
+
+        for db_block_height, coinbase, transactions in iter_blocks(h3, 1):
+            # the genesis block creates the initial supply
+            debited = apply_rows(balances, transactions, debit=db_block_height > 1)
+            while mirror is not None and -mirror[0] <= db_block_height:
+                apply_rows(balances, mirror[1])
+                mirror = next(mirror_blocks, None)
+
+            for address in debited:
+                if balances[address] < 0:
+                    yield Mismatch('balances', db_block_height, "Negative balance",
+                                   "{} {:.8f}".format(address, Decimal(balances[address]).scaleb(-8)))
+                    invalid = invalid + 1
+
+            if db_block_height >= print_step:
+                yield progress('balances', print_step, 1, last, started)
+                print_step += RANGE_STEP
 
-        for row in h3.execute('SELECT * FROM transactions where block_height<0 ORDER BY block_height DESC'):
+        while mirror is not None:
+            apply_rows(balances, mirror[1])
+            mirror = next(mirror_blocks, None)
+
+        app_log.info("Addresses with a balance: {}".format(len(balances)))
+        if balance_table:
+            write_balances(balances, balance_table)
+            app_log.info("Balance table written to {}".format(balance_table))
+
+        h3.close()
+        h4.close()
+        yield StageDone('balances', last, invalid)
+
+    except Exception as e:
+        app_log.error("Error: {}".format(e))
+        raise
+
+
+def expected_reward(db_block_height, db_recipient):
+    """Returns (reward, recipient) expected for a mirror row at the negative db_block_height"""
+    dev_acc = DEV_ACC
+    hn_acc = HN_ACC
+    rew_fork = REW_FORK
+
+    if db_block_height > - rew_fork:
+        rew_calc = 15 + db_block_height/1e6
+        recipient = dev_acc
+    elif db_block_height >= - HF2:
+        if db_recipient == dev_acc:
+            rew_calc = 15 - 0.8 + db_block_height/5e5
+            recipient = dev_acc
+        else:
+            rew_calc = 8.0
+            recipient = hn_acc
+    elif db_block_height > - HF3:
+        if db_recipient == dev_acc:
+            rew_calc = 15 - 2.4 + db_block_height/5e5
+            recipient = dev_acc
+        else:
+            rew_calc = 24.0
+            recipient = hn_acc
+    else:
+        if db_recipient == dev_acc:
+            rew_calc = 9.7
+            if db_block_height < -HF3:
+                rew_calc = 5.5 + (HF3+db_block_height)/1.1e6
+            recipient = dev_acc
+        else:
+            rew_calc = 10.0*(2.4 + (HF3+db_block_height-5)/3.0e6)
+            recipient = hn_acc
+
+    return rew_calc, recipient
+
+
+def verify_rewards(app_log, db, checkpoint=None):
+    return log_events(app_log, iter_verify_rewards(app_log, db, checkpoint))
+
+
+def iter_verify_rewards(app_log, db, checkpoint=None):
+    """verify_rewards as a generator of Progress, Mismatch and StageDone events, heights are those of the blocks"""
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+
+    try:
+        app_log.info("Verification of rewards started...")
+        print_step = 50000
+        height, invalid, done = resume_checkpoint(app_log, checkpoint, 'rewards', ledger_check)
+        last_height = -height
+        h3.execute("SELECT min(block_height) FROM transactions")
+        last = -min(h3.fetchone()[0] or 0, 0)
+        started = time.time()
+
+        rows = [] if done else h3.execute('SELECT * FROM transactions where block_height<? '
+                                          'ORDER BY block_height DESC', (-height,))
+        for row in rows:
             db_block_height = row[0]
             db_recipient = row[3]
             db_amount = row[4]
 
-            if db_block_height > - rew_fork:
-                rew_calc = 15 + db_block_height/1e6
-                recipient = dev_acc
-            elif db_block_height >= - HF2:
-                if db_recipient == dev_acc:
-                    rew_calc = 15 - 0.8 + db_block_height/5e5
-                    recipient = dev_acc
-                else:
-                    rew_calc = 8.0
-                    recipient = hn_acc
-            elif db_block_height > - HF3:
-                if db_recipient == dev_acc:
-                    rew_calc = 15 - 2.4 + db_block_height/5e5
-                    recipient = dev_acc
-                else:
-                    rew_calc = 24.0
-                    recipient = hn_acc
-            else:
-                if db_recipient == dev_acc:
-                    rew_calc = 9.7
-                    if db_block_height < -HF3:
-                        rew_calc = 5.5 + (HF3+db_block_height)/1.1e6
-                    recipient = dev_acc
-                else:
-                    rew_calc = 10.0*(2.4 + (HF3+db_block_height-5)/3.0e6)
-                    recipient = hn_acc
+            # all mirror rows of the previous height are verified
+            if db_block_height != last_height:
+                save_checkpoint(checkpoint, 'rewards', ledger_check, -last_height, invalid)
+                last_height = db_block_height
 
-            rew_difference = quantize_eight(db_amount - rew_calc)
-            if (rew_difference != 0) or (db_recipient != recipient):
-                app_log.warning("Reward mismatch: {} {} {} {}".format(db_block_height,rew_difference,db_amount,rew_calc))
+            rew_calc, recipient = expected_reward(db_block_height, db_recipient)
+
+            if (to_units(db_amount - rew_calc, 8) != 0) or (db_recipient != recipient):
+                rew_difference = quantize_eight(db_amount - rew_calc)
+                yield Mismatch('rewards', db_block_height, "Reward mismatch",
+                               "{} {} {}".format(rew_difference, db_amount, rew_calc))
                 invalid = invalid + 1
 
             if -db_block_height > print_step:
-                app_log.info("Bismuth rewards verified = {}".format(print_step))
+                yield progress('rewards', print_step, height + 1, last, started)
                 print_step += 50000
 
+        save_checkpoint(checkpoint, 'rewards', ledger_check, -last_height, invalid, done=True)
+        h3.close()
+        yield StageDone('rewards', -last_height, invalid)
+
+    except Exception as e:
+        app_log.error("Error: {}".format(e))
+        raise
+
+
+def expected_rewards(heights, is_dev):
+    """Expected mirror rewards in units of 1e-8 BIS, same branches as verify_rewards
+
+    heights are the negative mirror heights as an int64 array, is_dev tells which rows pay dev_acc.
+    All formulas are exact integer arithmetic.
+    """
+    return np.select(
+        [heights > -REW_FORK,
+         (heights >= -HF2) & is_dev,
+         heights >= -HF2,
+         (heights > -HF3) & is_dev,
+         heights > -HF3,
+         (heights == -HF3) & is_dev,
+         is_dev],
+        [1500000000 + heights * 100,                                  # 15 + h/1e6
+         1420000000 + heights * 200,                                  # 15 - 0.8 + h/5e5
+         np.int64(800000000),                                         # 8.0
+         1260000000 + heights * 200,                                  # 15 - 2.4 + h/5e5
+         np.int64(2400000000),                                        # 24.0
+         np.int64(970000000),                                         # 9.7
+         550000000 + round_half_even((HF3 + heights) * 1000, 11)],    # 5.5 + (HF3+h)/1.1e6
+        2400000000 + round_half_even((HF3 + heights - 5) * 1000, 3))  # 10*(2.4 + (HF3+h-5)/3e6)
+
+
+def reward_mismatches(heights, recipients, amounts):
+    """Returns the indices of mirror rows whose recipient or amount differs from the reward rules,
+    and the expected amounts in units of 1e-8 BIS"""
+    heights = np.asarray(heights, dtype=np.int64)
+    is_dev = np.fromiter((recipient == DEV_ACC for recipient in recipients), dtype=bool, count=len(recipients))
+    is_hn = np.fromiter((recipient == HN_ACC for recipient in recipients), dtype=bool, count=len(recipients))
+    units = np.rint(np.asarray(amounts, dtype=np.float64) * 1e8).astype(np.int64)
+
+    expected = expected_rewards(heights, is_dev)
+    wrong_recipient = np.where(heights > -REW_FORK, ~is_dev, ~(is_dev | is_hn))
+    return np.flatnonzero((units != expected) | wrong_recipient), expected
+
+
+def verify_rewards_vectorized(app_log, db, checkpoint=None):
+    """verify_rewards on NumPy arrays: mirror rows are loaded in chunks and checked with integer arithmetic"""
+    return log_events(app_log, iter_verify_rewards_vectorized(app_log, db, checkpoint))
+
+
+def iter_verify_rewards_vectorized(app_log, db, checkpoint=None):
+    """verify_rewards_vectorized as a generator of Progress, Mismatch and StageDone events"""
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+
+    try:
+        app_log.info("Verification of rewards started...")
+        height, invalid, done = resume_checkpoint(app_log, checkpoint, 'rewards', ledger_check)
+        last_height = -height
+        h3.execute("SELECT min(block_height) FROM transactions")
+        last = -min(h3.fetchone()[0] or 0, 0)
+        started = time.time()
+
+        rows = []
+        h3.execute('SELECT block_height, recipient, amount FROM transactions WHERE block_height < ? '
+                   'ORDER BY block_height DESC', (-height,))
+        while not done:
+            fetched = h3.fetchmany(REWARD_CHUNK)
+            rows.extend(fetched)
+            if not rows:
+                break
+            # keep the rows of the last height for the next chunk, so a chunk always ends on a complete height
+            split = len(rows)
+            if fetched:
+                while split > 0 and rows[split - 1][0] == rows[-1][0]:
+                    split -= 1
+                if split == 0:
+                    continue
+            chunk, rows = rows[:split], rows[split:]
+
+            heights, recipients, amounts = zip(*chunk)
+            mismatches, expected = reward_mismatches(heights, recipients, amounts)
+            for i in mismatches:
+                rew_calc = Decimal(int(expected[i])).scaleb(-8)
+                yield Mismatch('rewards', heights[i], "Reward mismatch",
+                               "{} {} {}".format(quantize_eight(Decimal(amounts[i]) - rew_calc), amounts[i], rew_calc))
+            invalid = invalid + len(mismatches)
+
+            last_height = heights[-1]
+            save_checkpoint(checkpoint, 'rewards', ledger_check, -last_height, invalid)
+            yield progress('rewards', -last_height, height + 1, last, started)
+
+        save_checkpoint(checkpoint, 'rewards', ledger_check, -last_height, invalid, done=True)
         h3.close()
+        yield StageDone('rewards', -last_height, invalid)
 
     except Exception as e:
         app_log.error("Error: {}".format(e))
         raise
 
+
+def sample_heights(last, count, seed, last_blocks):
+    """Returns (random heights, fixed heights) of a sample of blocks 1..last
+
+    count heights are drawn uniformly with the given seed, the fixed heights are the last
+    last_blocks blocks and the fork boundaries that are not already drawn.
+    """
+    sampled = set(random.Random(seed).sample(range(1, last + 1), min(count, last)))
+    fixed = set(range(max(1, last - last_blocks + 1), last + 1))
+    for fork in FORK_HEIGHTS:
+        fixed.update(height for height in (fork - 1, fork, fork + 1) if 1 <= height <= last)
+    return sorted(sampled), sorted(fixed - sampled)
+
+
+def sample_confidence(count, corruption_rate):
+    """Probability that count uniformly drawn blocks include at least one corrupted block"""
+    return 1 - (1 - corruption_rate) ** count
+
+
+def verify_sample_block(app_log, h3, db_block_height):
+    """Verifies the signatures, hash and difficulty of one block, returns the number of invalid entries"""
+    invalid = 0
+    transactions = h3.execute("SELECT * FROM transactions WHERE block_height = ? ORDER BY rowid",
+                              (db_block_height,)).fetchall()
+    coinbase = next((row for row in transactions if row[9] != 0), None)
+    if coinbase is None:
+        app_log.warning("Block missing: {}".format(db_block_height))
+        return 1
+
+    for row in transactions:
+        if row[9] == 0 and not verify_tx(row, []):
+            app_log.warning("Signature validation problem: {}".format(db_block_height))
+            invalid = invalid + 1
+
+    h3.execute("SELECT block_hash FROM transactions WHERE reward != 0 AND block_height < ? "
+               "ORDER BY block_height DESC LIMIT 1", (db_block_height,))
+    result = h3.fetchone()
+    if db_block_height > 1 and not verify_block(db_block_height, transactions, str(coinbase[7]),
+                                                str(result[0]) if result else ""):
+        app_log.warning("Block hash mismatch: {}".format(db_block_height))
+        invalid = invalid + 1
+
+    if db_block_height > DIFF_START:
+        difficulty = h3.execute("SELECT difficulty FROM misc WHERE block_height = ?", (db_block_height,)).fetchone()
+        h3.execute("SELECT transactions.timestamp, transactions.block_hash FROM misc "
+                   "JOIN transactions ON transactions.block_height = misc.block_height "
+                   "WHERE misc.block_height > ? AND misc.block_height < ? AND transactions.reward != 0 "
+                   "ORDER BY misc.block_height DESC LIMIT 1", (DIFF_START, db_block_height))
+        result = h3.fetchone()
+        if difficulty is not None and result is not None and len(str(result[1])) > 1:
+            if not check_block(db_block_height, str(coinbase[2]), str(coinbase[11]), str(result[1]),
+                               int(float(difficulty[0])), to_units(coinbase[1], 2), to_units(result[0], 2)):
+                app_log.warning("Diff mismatch: {}".format(db_block_height))
+                invalid = invalid + 1
+
     return invalid
 
 
+def verify_sample(app_log, db, count, seed=None, last_blocks=1000, corruption_rate=0.001,
+                  cache_file=None, key_cache_size=4096):
+    """Spot check: verifies signatures, hashes and difficulty of a seeded random sample of blocks,
+    the last last_blocks blocks and the fork boundaries. Returns (invalid, confidence)
+
+    confidence is the probability that the random part of the sample hits at least one
+    corrupted block if a fraction corruption_rate of all blocks is corrupted.
+    """
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+
+    try:
+        if seed is None:
+            seed = random.SystemRandom().randrange(2 ** 32)
+        h3.execute("SELECT max(block_height) FROM transactions")
+        last = h3.fetchone()[0] or 0
+        sampled, fixed = sample_heights(last, count, seed, last_blocks)
+        app_log.info("Sample verification started: {} random blocks (seed {}) and {} fixed blocks"
+                     .format(len(sampled), seed, len(fixed)))
+
+        init_txs_worker(cache_file, key_cache_size)
+        mining_open()
+        invalid = 0
+        heights = sorted(sampled + fixed)
+        for i, db_block_height in enumerate(heights, 1):
+            invalid = invalid + verify_sample_block(app_log, h3, db_block_height)
+            if i % 1000 == 0:
+                app_log.info("Sampled blocks verified = {} of {}".format(i, len(heights)))
+
+        confidence = sample_confidence(len(sampled), corruption_rate)
+        if invalid == 0:
+            app_log.info("All sampled blocks are valid, {:.4%} confidence to detect corruption of {} of blocks"
+                         .format(confidence, corruption_rate))
+        else:
+            app_log.warning("{} invalid entries found in the sampled blocks".format(invalid))
+
+        h3.close()
+
+    except Exception as e:
+        app_log.error("Error: {}".format(e))
+        raise
+
+    return invalid, confidence
+
+
+class SignatureCheck(Check):
+    """Transaction signatures, as verify_txs"""
+
+    name = 'signatures'
+
+    def __init__(self, app_log, cache_file=None, key_cache_size=4096):
+        super().__init__(app_log)
+        # the writer creates the cache file before the read-only lookups open it
+        self.cache = SignatureCache(cache_file) if cache_file else None
+        init_txs_worker(cache_file, key_cache_size)
+        self.verified = []
+
+    def on_block(self, block_height, coinbase, transactions):
+        for row in transactions:
+            if row[9] == 0 and not verify_tx(row, self.verified):
+                self.fail("Signature validation problem: {}".format(block_height))
+        if self.cache is not None and len(self.verified) >= 10000:
+            self.cache.add(self.verified)
+            self.verified = []
+
+    def finish(self):
+        if self.cache is not None:
+            self.cache.add(self.verified)
+            self.cache.close()
+        super().finish()
+
+
+class BlockHashCheck(Check):
+    """Block hashes chained on the stored hash of the previous block, as verify_blocks"""
+
+    name = 'hashes'
+
+    def __init__(self, app_log):
+        super().__init__(app_log)
+        self.db_block_hash_prev = ""
+
+    def on_block(self, block_height, coinbase, transactions):
+        if coinbase is None:
+            return
+        db_block_hash = str(coinbase[7])
+        if block_height > 1 and not verify_block(block_height, transactions, db_block_hash, self.db_block_hash_prev):
+            self.fail("Block hash mismatch: {}".format(block_height))
+        self.db_block_hash_prev = db_block_hash
+
+
+class RewardCheck(Check):
+    """Dev and hypernode mirror rewards, as verify_rewards"""
+
+    name = 'rewards'
+
+    def on_mirror(self, row):
+        db_block_height, db_recipient, db_amount = row[0], row[3], row[4]
+        rew_calc, recipient = expected_reward(db_block_height, db_recipient)
+        if (to_units(db_amount - rew_calc, 8) != 0) or (db_recipient != recipient):
+            rew_difference = quantize_eight(db_amount - rew_calc)
+            self.fail("Reward mismatch: {} {} {} {}".format(db_block_height, rew_difference, db_amount, rew_calc))
+
+
+class DuplicateSignatureCheck(Check):
+    """No signature is used twice, except in ALLOWED_DUPES
+
+    16 byte digests of the signatures are spilled to partition files during the scan,
+    finish() loads one partition at a time and confirms the repeated digests on the full
+    signatures in db. Every row of a duplicate group is reported, as in check_dupes.
+    """
+
+    name = 'dupes'
+
+    def __init__(self, app_log, db, temp_dir=None):
+        super().__init__(app_log)
+        self.db = db
+        self.digests = sig_dupes.DigestSpill(temp_dir=temp_dir)
+
+    def on_block(self, block_height, coinbase, transactions):
+        for row in transactions:
+            if row[5] != '0':
+                self.digests.add(sig_dupes.signature_digest(row[5]), block_height)
+
+    def finish(self):
+        candidates = {}
+        try:
+            for name in self.digests.close():
+                candidates.update(sig_dupes.partition_candidates(name))
+        finally:
+            self.digests.cleanup()
+        with connect_readonly(self.db) as ledger_check:
+            rows = sig_dupes.confirm(ledger_check.cursor(), candidates)
+        ledger_check.close()
+        for row in rows:
+            if row[0] not in ALLOWED_DUPES:
+                self.fail("Duplicate signature in block {}".format(row[0]))
+        super().finish()
+
+
+class TimestampCheck(Check):
+    """Every block is more recent than the previous one
+
+    Opt-in (--checks ...,timestamps): this is not a rule of the node's block acceptance nor
+    of the baseline checks, it only reports blocks whose timestamp is out of order.
+    """
+
+    name = 'timestamps'
+
+    def __init__(self, app_log):
+        super().__init__(app_log)
+        self.timestamp_prev = None
+
+    def on_block(self, block_height, coinbase, transactions):
+        if coinbase is None:
+            return
+        timestamp = quantize_two(coinbase[1])
+        if self.timestamp_prev is not None and timestamp <= self.timestamp_prev:
+            self.fail("Block timestamp not after the previous block: {}".format(block_height))
+        self.timestamp_prev = timestamp
+
+
+def ledger_checks(app_log, db, names, cache_file=None, key_cache_size=4096):
+    """Builds the checks for scan_ledger from their names"""
+    checks = {'signatures': lambda: SignatureCheck(app_log, cache_file, key_cache_size),
+              'hashes': lambda: BlockHashCheck(app_log),
+              'rewards': lambda: RewardCheck(app_log),
+              'dupes': lambda: DuplicateSignatureCheck(app_log, db),
+              'timestamps': lambda: TimestampCheck(app_log)}
+    return [checks[name]() for name in names]
+
+
 if __name__ == "__main__":
-    my_log = log.log("verify.log", "INFO", True)
+    parser = argparse.ArgumentParser(description='Verify the Bismuth ledger in static/ledger.db')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes used for signature, block hash and diff verification (default 1)')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue an interrupted run from verify_checkpoint.json')
+    parser.add_argument('--checkpoint-every', type=int, default=100000,
+                        help='save the progress of each stage every N blocks (default 100000)')
+    parser.add_argument('--full', action='store_true',
+                        help='verify from genesis instead of from the tip each stage verified in the last valid run')
+    parser.add_argument('--key-cache-size', type=int, default=4096,
+                        help='parsed public keys kept per worker for signature verification (default 4096)')
+    parser.add_argument('--single-scan', action='store_true',
+                        help='run the transaction checks in one pass over the ledger, then the diff stage, '
+                             'always from genesis and without saving verified tips')
+    parser.add_argument('--checks', default='signatures,hashes,rewards,dupes',
+                        help='checks of the single scan, comma separated: signatures, hashes, rewards, dupes '
+                             'and the opt-in timestamps (default all but timestamps)')
+    parser.add_argument('--retarget', action='store_true',
+                        help='also recompute the stored difficulty of every block from the retarget rules')
+    parser.add_argument('--retarget-tolerance', type=float, default=RETARGET_TOLERANCE,
+                        help='largest accepted difference with the recomputed difficulty (default {})'
+                        .format(RETARGET_TOLERANCE))
+    parser.add_argument('--balances', action='store_true',
+                        help='also replay all transactions and check that no balance goes negative')
+    parser.add_argument('--balance-table', default=None,
+                        help='with --balances, write the final balance of every address to this csv file')
+    parser.add_argument('--sample', type=int, default=0,
+                        help='spot check N random blocks, the last blocks and the fork boundaries instead of the full ledger')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='seed of the random sample, to reproduce a spot check (default random, logged)')
+    parser.add_argument('--last', type=int, default=1000,
+                        help='number of most recent blocks always included in the sample (default 1000)')
+    parser.add_argument('--corruption-rate', type=float, default=0.001,
+                        help='fraction of corrupted blocks the reported sample confidence refers to (default 0.001)')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='audit mode: verify every signature, ignoring the sig_cache file of snapshot.json')
+    args = parser.parse_args()
 
-    invalid1 = verify_txs(my_log, 'static/ledger.db', True)
-    invalid2 = verify_blocks(my_log, 'static/ledger.db')
-    invalid3 = verify_diff(my_log, 'static/ledger.db')
-    invalid4 = verify_rewards(my_log, 'static/ledger.db')
+    my_log = log.log("verify.log", "INFO", True)
 
     with open('snapshot.json') as json_data:
         config = json.load(json_data)
 
+    # opt-in cache of verified signatures, e.g. "sig_cache": "verified_sigs.db"
+    cache_file = None if args.no_cache else config.get('sig_cache')
+
+    # a spot check and a single scan verify without checkpoints, they leave them and the verified tips alone
+    checkpoint = Checkpoint('verify_checkpoint.json', args.checkpoint_every)
+    incremental = not args.sample and not args.single_scan
+    if incremental and not (args.resume and checkpoint.load()):
+        checkpoint.remove()
+        for name, tip in ({} if args.full else load_tips('verify_tip.json')).items():
+            # the stage checks that its tip block is unchanged before continuing from it
+            my_log.info("Verifying {} after the verified tip {}".format(name, tip['block_height']))
+            checkpoint.seed(name, tip)
+
+    if args.sample:
+        seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2 ** 32)
+        invalid1, confidence = verify_sample(my_log, 'static/ledger.db', args.sample, seed, args.last,
+                                             args.corruption_rate, cache_file, args.key_cache_size)
+        invalid2 = invalid3 = invalid4 = invalid5 = invalid6 = 0
+    elif args.single_scan:
+        checks = ledger_checks(my_log, 'static/ledger.db', args.checks.split(','), cache_file, args.key_cache_size)
+        invalid1 = sum(scan_ledger(my_log, 'static/ledger.db', checks).values())
+        invalid2 = invalid4 = 0
+        invalid3 = verify_diff(my_log, 'static/ledger.db', args.workers)
+        invalid5 = verify_retarget(my_log, 'static/ledger.db', args.workers, None,
+                                   args.retarget_tolerance) if args.retarget else 0
+        invalid6 = verify_balances(my_log, 'static/ledger.db', args.balance_table) if args.balances else 0
+    else:
+        invalid1 = verify_txs(my_log, 'static/ledger.db', True, args.workers, checkpoint, cache_file,
+                              args.key_cache_size)
+        invalid2 = verify_blocks(my_log, 'static/ledger.db', args.workers, checkpoint)
+        invalid3 = verify_diff(my_log, 'static/ledger.db', args.workers, checkpoint)
+        if np is not None:
+            invalid4 = verify_rewards_vectorized(my_log, 'static/ledger.db', checkpoint)
+        else:
+            invalid4 = verify_rewards(my_log, 'static/ledger.db', checkpoint)
+        invalid5 = verify_retarget(my_log, 'static/ledger.db', args.workers, checkpoint,
+                                   args.retarget_tolerance) if args.retarget else 0
+        invalid6 = verify_balances(my_log, 'static/ledger.db', args.balance_table) if args.balances else 0
+
     with open("{}/ledger.json".format(config['DB_PATH'])) as json_data:
         data = json.load(json_data)
 
-    if invalid1 + invalid2 + invalid3 + invalid4 == 0:
+    if args.sample:
+        # a spot check does not verify the ledger, data['valid'] is left to full runs
+        data['sample'] = {'valid': 'valid' if invalid1 == 0 else 'invalid', 'blocks': args.sample, 'seed': seed,
+                          'confidence': confidence, 'corruption_rate': args.corruption_rate}
+    elif invalid1 + invalid2 + invalid3 + invalid4 + invalid5 + invalid6 == 0:
         data['valid'] = 'valid'
+        data.pop('sample', None)
+        if incremental:
+            # each stage saves the last height it verified, blocks added while it ran are left to the next run,
+            # stages that did not run keep their tip
+            tips = load_tips('verify_tip.json')
+            tips.update(checkpoint.tips())
+            save_tips('verify_tip.json', tips)
     else:
         data['valid'] = 'invalid'
+        data.pop('sample', None)
 
     with open(config['DB_PATH'] + 'ledger.json', 'w') as outfile:
         json.dump(data, outfile)
 
+    if incremental:
+        checkpoint.remove()
+
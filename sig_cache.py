@@ -0,0 +1,49 @@
+"""
+On-disk cache of verified transaction signatures
+Only signatures that passed verification are stored, as 16 byte digests in a SQLite table
+"""
+
+import sqlite3
+import hashlib
+
+
+def signature_digest(signature, public_key, buffer):
+    """16 byte digest of a signature, its public key and the signed buffer"""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(signature.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(public_key.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(buffer)
+    return digest.digest()
+
+
+class SignatureCache:
+    """Set of verified signature digests stored in a SQLite file
+
+    The writer opens the file in WAL mode, so read-only workers can look up digests
+    while the writer adds the ones they verified.
+    """
+
+    def __init__(self, filename, readonly=False):
+        if readonly:
+            self.db = sqlite3.connect("file:{}?mode=ro".format(filename), uri=True)
+        else:
+            self.db = sqlite3.connect(filename)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS verified (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+            self.db.commit()
+
+    def __contains__(self, digest):
+        return self.db.execute("SELECT 1 FROM verified WHERE digest = ?", (digest,)).fetchone() is not None
+
+    def add(self, digests):
+        """Stores the digests of newly verified signatures"""
+        self.db.executemany("INSERT OR IGNORE INTO verified VALUES (?)", ((digest,) for digest in digests))
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute("SELECT count(*) FROM verified").fetchone()[0]
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,216 @@
+"""
+Duplicate signature detection with bounded memory
+16 byte digests of the signatures are spilled to hash partitioned temporary files, each partition
+is searched for repeated digests in memory and the candidates are confirmed on the full signatures
+An optional digest index keeps the digests of checked blocks, later runs only read the new blocks
+"""
+
+import os
+import sqlite3
+import hashlib
+import tempfile
+
+MEMORY_BUDGET = 256 * 2 ** 20  # bytes of digests held in memory at once
+ENTRY_COST = 120  # approximate bytes per digest held in a dict
+RECORD = 24  # 16 byte digest and 8 byte block height per spilled signature
+MAX_PARTITIONS = 256
+
+
+def signature_digest(signature):
+    return hashlib.blake2b(str(signature).encode("utf-8"), digest_size=16).digest()
+
+
+class DigestIndex:
+    """Digests of the signatures of all blocks up to an anchor block, stored in a SQLite file
+
+    The anchor is the height and hash of the last checked block. If that block changed,
+    the ledger is not the one indexed and the index is cleared. The duplicates found up to
+    the anchor are kept with their heights, so later runs report them again.
+    """
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS digests (digest BLOB PRIMARY KEY, block_height INTEGER) "
+                        "WITHOUT ROWID")
+        self.db.execute("CREATE TABLE IF NOT EXISTS anchor (block_height INTEGER, block_hash TEXT)")
+        # an index without the duplicates table does not know the duplicates found so far
+        rebuild = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'duplicates'").fetchone() is None
+        self.db.execute("CREATE TABLE IF NOT EXISTS duplicates (digest BLOB, block_height INTEGER)")
+        self.db.commit()
+        if rebuild:
+            self.clear()
+
+    def anchor(self):
+        return self.db.execute("SELECT block_height, block_hash FROM anchor").fetchone()
+
+    def lookup(self, digest):
+        """Height of the first block with this digest, None if it is not indexed"""
+        result = self.db.execute("SELECT block_height FROM digests WHERE digest = ?", (digest,)).fetchone()
+        return result[0] if result else None
+
+    def duplicates(self):
+        """{digest: heights} of the duplicates found up to the anchor"""
+        found = {}
+        for digest, block_height in self.db.execute("SELECT digest, block_height FROM duplicates"):
+            found.setdefault(digest, []).append(block_height)
+        return found
+
+    def add(self, items):
+        self.db.executemany("INSERT OR IGNORE INTO digests VALUES (?, ?)", items)
+
+    def clear(self):
+        self.db.execute("DELETE FROM digests")
+        self.db.execute("DELETE FROM anchor")
+        self.db.execute("DELETE FROM duplicates")
+        self.db.commit()
+
+    def commit(self, block_height, block_hash, duplicates):
+        """Saves the added digests together with the new anchor and the (digest, height) of all duplicates"""
+        self.db.execute("DELETE FROM anchor")
+        self.db.execute("INSERT INTO anchor VALUES (?, ?)", (block_height, block_hash))
+        self.db.execute("DELETE FROM duplicates")
+        self.db.executemany("INSERT INTO duplicates VALUES (?, ?)", duplicates)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def coinbase_hash(cursor, block_height):
+    result = cursor.execute("SELECT block_hash FROM transactions WHERE block_height = ? AND reward != 0",
+                            (block_height,)).fetchone()
+    return str(result[0]) if result else None
+
+
+class DigestSpill:
+    """Digest and height records written to hash partitioned files of a temporary directory
+
+    Partition p holds the digests whose first byte is in the p-th slice of 0..255, so
+    partitions cover increasing digest ranges. Records keep the order they were added in.
+    """
+
+    def __init__(self, partitions=MAX_PARTITIONS, temp_dir=None):
+        self.partitions = partitions
+        self.directory = tempfile.TemporaryDirectory(dir=temp_dir)
+        self.names = [os.path.join(self.directory.name, "dupes_{}.bin".format(p)) for p in range(partitions)]
+        self.files = [open(name, 'wb') for name in self.names]
+
+    def add(self, digest, block_height):
+        self.files[digest[0] * self.partitions >> 8].write(digest + block_height.to_bytes(8, 'little', signed=True))
+
+    def close(self):
+        """Closes the partition files, returns their names"""
+        for spill_file in self.files:
+            spill_file.close()
+        return self.names
+
+    def cleanup(self):
+        self.close()
+        self.directory.cleanup()
+
+
+def partition_count(rows, memory_budget=MEMORY_BUDGET):
+    """Number of partitions keeping the digests of one partition within memory_budget"""
+    return max(1, min(MAX_PARTITIONS, -(-rows * ENTRY_COST // memory_budget)))
+
+
+def spill(cursor, start, temp_dir, memory_budget):
+    """Spills digest and height of every signature of blocks above start, returns the DigestSpill"""
+    if start is None:
+        query, params = "SELECT block_height, signature FROM transactions WHERE signature != '0'", ()
+        count = cursor.execute("SELECT count(*) FROM transactions").fetchone()[0]
+    else:
+        query, params = ("SELECT block_height, signature FROM transactions WHERE block_height > ? "
+                         "AND signature != '0'", (start,))
+        count = cursor.execute("SELECT count(*) FROM transactions WHERE block_height > ?", (start,)).fetchone()[0]
+
+    digests = DigestSpill(partition_count(count, memory_budget), temp_dir)
+    try:
+        for block_height, signature in cursor.execute(query, params):
+            digests.add(signature_digest(signature), block_height)
+    finally:
+        digests.close()
+    return digests
+
+
+def partition_candidates(name, index=None, lookup=False):
+    """Returns {digest: heights} of the digests of a partition seen more than once, in it or, with lookup,
+    in the index
+
+    Digests first seen in the partition are added to the index, in digest order.
+    """
+    with open(name, 'rb') as spill_file:
+        data = spill_file.read()
+
+    first = {}
+    candidates = {}
+    for i in range(0, len(data), RECORD):
+        digest = data[i:i + 16]
+        block_height = int.from_bytes(data[i + 16:i + RECORD], 'little', signed=True)
+        if digest in first:
+            candidates.setdefault(digest, [first[digest]]).append(block_height)
+            continue
+        first[digest] = block_height
+        indexed = index.lookup(digest) if lookup else None
+        if indexed is not None:
+            candidates[digest] = [indexed, block_height]
+
+    if index is not None:
+        index.add(sorted(first.items()))
+    return candidates
+
+
+def confirm(cursor, candidates):
+    """Returns the rows whose exact signature appears in more than one row of the candidate heights"""
+    groups = {}
+    for digest, heights in candidates.items():
+        for block_height in sorted(set(heights)):
+            for row in cursor.execute("SELECT * FROM transactions WHERE block_height = ?", (block_height,)).fetchall():
+                if row[5] != '0' and signature_digest(row[5]) == digest:
+                    groups.setdefault(row[5], []).append(row)
+    rows = [row for group in groups.values() if len(group) > 1 for row in group]
+    return sorted(rows, key=lambda row: row[0])
+
+
+def find_duplicate_signatures(db, index_file=None, memory_budget=MEMORY_BUDGET, temp_dir=None):
+    """Returns all transaction rows whose signature (other than '0') is used more than once
+
+    With index_file, only signatures of blocks added since the previous run are looked up, against
+    the index and among themselves, and the index is then extended to the last block. Duplicates
+    found by earlier runs are confirmed and returned again.
+    """
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+
+        index = DigestIndex(index_file) if index_file else None
+        start = None
+        if index is not None:
+            anchor = index.anchor()
+            if anchor is not None and coinbase_hash(h3, anchor[0]) == anchor[1]:
+                start = anchor[0]
+            else:
+                index.clear()
+
+        h3.execute("SELECT max(block_height) FROM transactions")
+        last = h3.fetchone()[0] or 0
+
+        candidates = {}
+        digests = spill(h3, start, temp_dir, memory_budget)
+        try:
+            for name in digests.names:
+                candidates.update(partition_candidates(name, index, start is not None))
+                os.remove(name)
+        finally:
+            digests.cleanup()
+        if start is not None:
+            for digest, heights in index.duplicates().items():
+                candidates.setdefault(digest, []).extend(heights)
+
+        results = confirm(h3, candidates)
+        if index is not None:
+            index.commit(last, coinbase_hash(h3, last), [(signature_digest(row[5]), row[0]) for row in results])
+            index.close()
+        h3.close()
+
+    return results
@@ -0,0 +1,169 @@
+"""
+Compressed tar archives of the snapshot DBs
+gzip archives are written as concatenated gzip members compressed in parallel threads, any gzip
+reader (tarfile, gunzip, pigz) reads them as one stream. zstd archives need the optional
+zstandard module and are compressed with its worker threads.
+"""
+
+import os
+import gzip
+import zlib
+import shutil
+import hashlib
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSIONS = {"gzip": ".tar.gz", "zstd": ".tar.zst"}
+LEVELS = {"gzip": 9, "zstd": 3}  # default levels, gzip as tarfile "w:gz"
+MAGIC = {"gzip": b"\x1f\x8b", "zstd": b"\x28\xb5\x2f\xfd"}
+CHUNK = 16 * 2 ** 20  # uncompressed bytes per gzip member
+COPY_BUFFER = 2 ** 20
+
+
+class HashingTee:
+    """File object passing reads or writes through to fileobj, counting and sha256 hashing the bytes"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self.fileobj.write(data)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.sha256.update(data)
+        self.size += len(data)
+        return data
+
+
+def gzip_member(data, level):
+    """data as a complete gzip member, zlib releases the GIL while compressing"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ParallelGzipWriter:
+    """Write-only file object compressing CHUNK sized pieces into gzip members in a thread pool
+
+    Members are written in order, at most two per thread are pending at once.
+    """
+
+    def __init__(self, fileobj, level=LEVELS["gzip"], threads=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.threads = threads or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.members = 0
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= CHUNK:
+            self.submit(bytes(self.buffer[:CHUNK]))
+            del self.buffer[:CHUNK]
+        return len(data)
+
+    def submit(self, data):
+        self.pending.append(self.executor.submit(gzip_member, data, self.level))
+        self.members += 1
+        while len(self.pending) > 2 * self.threads:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        try:
+            if self.buffer or not self.members:
+                self.submit(bytes(self.buffer))
+                self.buffer.clear()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+
+
+def compressor(fileobj, codec, level=None, threads=None):
+    """Write-only file object compressing into fileobj, close() flushes it but leaves fileobj open"""
+    if level is None:
+        level = LEVELS[codec]
+    if codec == "gzip":
+        return ParallelGzipWriter(fileobj, level, threads)
+    if codec == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd archives need the zstandard module (pip install zstandard)")
+        return zstandard.ZstdCompressor(level=level, threads=threads or -1).stream_writer(fileobj, closefd=False)
+    raise ValueError(f"Unknown archive codec {codec}")
+
+
+def write_archive(path, members, codec="gzip", level=None, threads=None):
+    """
+    Writes the (filename, arcname) members to a tar archive compressed with codec.
+    Returns the sha256 and size of the archive and the name, size and sha256 of every member,
+    all computed while the bytes are written.
+    """
+    accounts = []
+    with open(path, "wb") as f:
+        archive = HashingTee(f)
+        stream = compressor(archive, codec, level, threads)
+        try:
+            with tarfile.open(fileobj=stream, mode="w|") as tar:
+                for filename, arcname in members:
+                    tarinfo = tar.gettarinfo(filename, arcname=arcname)
+                    with open(filename, "rb") as member_file:
+                        member = HashingTee(member_file)
+                        tar.addfile(tarinfo, member)
+                    accounts.append({"name": arcname, "size": member.size, "sha256": member.sha256.hexdigest()})
+        finally:
+            # shuts down the compression threads, also when tarfile raised
+            stream.close()
+    return {"sha256": archive.sha256.hexdigest(), "size": archive.size, "members": accounts}
+
+
+def detect_codec(path):
+    """Codec of an archive from its first bytes"""
+    with open(path, "rb") as f:
+        head = f.read(4)
+    for codec, magic in MAGIC.items():
+        if head.startswith(magic):
+            return codec
+    raise ValueError(f"{path} is neither a gzip nor a zstd archive")
+
+
+def extract_archive(path, directory):
+    """
+    Extracts the files and directories of a gzip or zstd archive into directory, reading it once as a
+    stream. Other members (links, devices) and members outside directory are refused.
+    """
+    codec = detect_codec(path)
+    with open(path, "rb") as f:
+        if codec == "zstd":
+            if zstandard is None:
+                raise ImportError("zstd archives need the zstandard module (pip install zstandard)")
+            stream = zstandard.ZstdDecompressor().stream_reader(f)
+        else:
+            # GzipFile reads all members, the "r|gz" stream of tarfile stops after the first one
+            stream = gzip.GzipFile(fileobj=f)
+
+        abs_directory = os.path.abspath(directory)
+        with tarfile.open(fileobj=stream, mode="r|") as tar:
+            for member in tar:
+                target = os.path.abspath(os.path.join(directory, member.name))
+                if os.path.commonpath([abs_directory, target]) != abs_directory or target == abs_directory:
+                    raise ValueError(f"Attempted path traversal in archive: {member.name}")
+                if member.isdir():
+                    os.makedirs(target, exist_ok=True)
+                    continue
+                if not member.isfile():
+                    raise ValueError(f"Unexpected archive member {member.name}")
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with tar.extractfile(member) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, COPY_BUFFER)
@@ -19,11 +19,14 @@ import math
 import json
 import sqlite3
 import hashlib
-import tarfile
+import multiprocessing
 import connections
+import db_compare
+import snapshot_archive
 from decimal import Decimal
 from quantizer import *
 from shutil import copyfile
+from block_stream import iter_blocks
 
 
 # ---------------------------------------------------------------------
@@ -63,7 +66,11 @@ def max_block_height(db):
     return last
 
 
-def check_integrity(db1, db2):
+def check_integrity(db1, db2, compare=False):
+    """
+    Check the table layout of db1 and the last height of both DBs.
+    With compare, also compare the rows of all shared heights (db_compare).
+    """
     ok = True
     with sqlite3.connect(db1) as l:
         l.text_factory = str
@@ -79,9 +86,51 @@ def check_integrity(db1, db2):
     if max_block_height(db1) != max_block_height(db2):
         ok = False
 
+    if ok and compare:
+        first, last = db_compare.shared_range(db1, db2)
+        for height in db_compare.compare_dbs(db1, db2, first, last):
+            print(f"Block {height} differs between {db1} and {db2}")
+            ok = False
+
     return ok
 
 
+def capture_db(source, target, pages=-1, sleep=0.25, max_restarts=10):
+    """
+    Consistent copy of a DB in use by node.py, through the SQLite online backup API.
+    pages < 1 copies everything in one step, else pages are copied per step with
+    sleep seconds in between. A write of the node between steps restarts the copy,
+    the capture fails after max_restarts restarts.
+
+    A step holds a read lock on the source. In WAL mode the node keeps writing meanwhile,
+    in rollback journal mode its writes wait or fail until the step ends, so a one step
+    copy is refused there.
+    """
+    src = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    restarts = 0
+    remaining_prev = None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, remaining_prev
+        # a restarted copy does not have fewer pages left than after the previous step
+        if remaining_prev is not None and remaining >= remaining_prev:
+            restarts += 1
+            if restarts > max_restarts:
+                raise RuntimeError(f"Capture of {source} restarted {restarts} times by node writes")
+        remaining_prev = remaining
+
+    try:
+        journal_mode = src.execute("PRAGMA journal_mode").fetchone()[0]
+        if journal_mode.lower() != "wal" and pages < 1:
+            raise ValueError(f"{source} is in {journal_mode} journal mode, a one step copy would block node.py, "
+                             f"set capture_pages")
+        src.backup(dst, pages=pages, progress=progress, sleep=sleep)
+    finally:
+        dst.close()
+        src.close()
+
+
 def vacuum(db):
     with sqlite3.connect(db) as ledger:
         ledger.text_factory = str
@@ -93,57 +142,176 @@ def vacuum(db):
 # ---------------------------------------------------------------------
 # Mirror DB writing (dev + hypernode payouts)
 # ---------------------------------------------------------------------
-def dev_reward(cursor, block_height, timestamp, mining_reward, hn_reward, mirror_hash):
+MIRROR_INSERT = "INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?,?,?,?)"
+MIRROR_RANGE = 100_000   # blocks per mirror rebuild job
+
+
+def mirror_entries(block_height, timestamp, mining_reward, hn_reward, mirror_hash):
     """
-    Insert DEV + HN mirror entries.
+    DEV + HN mirror rows of a block.
 
-    IMPORTANT:
-    - Called only every 10th block (matching digest.py)
     - mining_reward and hn_reward are already the *mirror* amounts
       (8, 24, or 10×HN depending on phase)
-    - After HF4: return without writing anything
+    - After HF4: no rows
     """
     if block_height >= HF4:
-        return
+        return []
 
     # Development reward entry
-    cursor.execute(
-        "INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
-        (-block_height,
-         timestamp,
-         "Development Reward",
-         "4edadac9093d9326ee4b17f869b14f1a2534f96f9c5d7b48dc9acaed",
-         str(mining_reward),
-         "0","0", mirror_hash,
-         "0","0","0","0")
-    )
+    entries = [(-block_height,
+                timestamp,
+                "Development Reward",
+                "4edadac9093d9326ee4b17f869b14f1a2534f96f9c5d7b48dc9acaed",
+                str(mining_reward),
+                "0","0", mirror_hash,
+                "0","0","0","0")]
 
     # Hypernode payout entry
     if hn_reward > 0:
-        cursor.execute(
-            "INSERT INTO transactions VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
-            (-block_height,
-             timestamp,
-             "Hypernode Payouts",
-             "3e08b5538a4509d9daa99e01ca5912cda3e98a7f79ca01248c2bde16",
-             str(hn_reward),
-             "0","0", mirror_hash,
-             "0","0","0","0")
+        entries.append((-block_height,
+                        timestamp,
+                        "Hypernode Payouts",
+                        "3e08b5538a4509d9daa99e01ca5912cda3e98a7f79ca01248c2bde16",
+                        str(hn_reward),
+                        "0","0", mirror_hash,
+                        "0","0","0","0"))
+    return entries
+
+
+def dev_reward(cursor, block_height, timestamp, mining_reward, hn_reward, mirror_hash):
+    """
+    Insert DEV + HN mirror entries.
+
+    IMPORTANT:
+    - Called only every 10th block (matching digest.py)
+    - After HF4: return without writing anything
+    """
+    cursor.executemany(MIRROR_INSERT, mirror_entries(block_height, timestamp, mining_reward, hn_reward,
+                                                     mirror_hash))
+
+
+def mirror_rewards(bh):
+    """Historical (mining_reward, hn_reward) mirror amounts of block bh"""
+    if bh < HF1:
+        mining_reward = Decimal(15) - (Decimal(bh) / Decimal(1_000_000))
+        hn_reward = Decimal("0.0")
+
+    elif bh <= HF2:
+        mining_reward = (
+            Decimal(15)
+            - Decimal(bh) / Decimal(500_000)
+            - Decimal("0.8")
+        )
+        hn_reward = Decimal("8.0")   # 10 × 0.8
+
+    elif bh < HF3:
+        mining_reward = (
+            Decimal(15)
+            - Decimal(bh) / Decimal(500_000)
+            - Decimal("2.4")
+        )
+        hn_reward = Decimal("24.0")  # 10 × 2.4
+
+    else:
+        # BGV linear phase until tail
+        mining_reward = Decimal("5.5") - Decimal(bh - HF3) / Decimal("1100000")
+        hn_reward = Decimal("10.0") * (
+            Decimal("2.4") - (Decimal(bh - HF3 + 5) / Decimal("3000000"))
         )
+        if mining_reward < Decimal("0.5"):
+            mining_reward = Decimal("0.5")
+        if hn_reward < Decimal("0.5"):
+            hn_reward = Decimal("0.5")
+
+    # HF4 removal of dev + HN entirely
+    if bh >= HF4:
+        mining_reward = Decimal("0")
+        hn_reward = Decimal("0")
+
+    return mining_reward, hn_reward
+
+
+def mirror_range(args):
+    """
+    Worker: (block_height, timestamp, mining_reward, hn_reward, mirror_hash)
+    of every 10th block of start..end, read in one ordered scan.
+    """
+    db, start, end = args
+    with sqlite3.connect(f"file:{db}?mode=ro", uri=True) as ledger:
+        ledger.text_factory = str
+        c = ledger.cursor()
+        payouts = []
+        for bh, coinbase, tx_list in iter_blocks(c, start, end, 10):
+            timestamp = tx_list[-1][1]  # timestamp of coinbase tx
+            mining_reward, hn_reward = mirror_rewards(bh)
+            mirror_hash = hashlib.blake2b(str(tx_list).encode(), digest_size=20).hexdigest()
+            payouts.append((bh, timestamp, mining_reward, hn_reward, mirror_hash))
+        c.close()
+    ledger.close()
+    return payouts
+
+
+# ---------------------------------------------------------------------
+# Mirror state (anchor of the last rebuild)
+# ---------------------------------------------------------------------
+def load_mirror_state(filename):
+    """Height, block_hash, mirror row count and digest of the last rebuild, None if there is none"""
+    if not filename or not os.path.isfile(filename):
+        return None
+    with open(filename) as f:
+        return json.load(f)
+
+
+def save_mirror_state(filename, state):
+    """Writes the state through a temporary file, a crash never leaves a partial state"""
+    temp = filename + ".tmp"
+    with open(temp, "w") as out:
+        json.dump(state, out)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(temp, filename)
+
+
+def coinbase_hash(cursor, block_height):
+    cursor.execute(
+        "SELECT block_hash FROM transactions WHERE block_height=? AND reward != 0",
+        (block_height,)
+    )
+    result = cursor.fetchone()
+    return str(result[0]) if result else None
+
+
+def mirror_digest(db, block_height):
+    """
+    (row count, digest) of the mirror entries of blocks 1..block_height, the digest
+    is the db_compare segment digest of all their columns.
+    """
+    count, total = db_compare.segment_digest((db, -block_height, 0, db_compare.COLUMNS))
+    return count, format(total, "032x")
 
 
 # ---------------------------------------------------------------------
 # Mirror block rebuild (core of correct snapshot generation)
 # ---------------------------------------------------------------------
-def redo_mirror_blocks(ledgerfile):
+def redo_mirror_blocks(ledgerfile, workers=None, state_file=None, directory="static/"):
     """
-    Rebuild dev + HN payouts in static/ledgerfile using *historically correct*
+    Rebuild dev + HN payouts in directory + ledgerfile using *historically correct*
     reward logic, including HF1/HF2/HF3/HF4 behavior.
 
     This matches the actual chain and all existing mainnet nodes.
+
+    Mirror hashes are computed by height range in a process pool before the
+    old entries are deleted, the new entries are then written in one transaction.
+    Nothing is written from HF4 on, so those blocks are not read.
+
+    With state_file, the height and block hash of the rebuild and the digest of the
+    entries up to it are saved. The next rebuild only redoes the entries above that
+    height if the block there still has the same hash and the entries below it still
+    have the same digest, else everything.
     """
+    db = directory + ledgerfile
 
-    conn = sqlite3.connect("static/" + ledgerfile)
+    conn = sqlite3.connect(db)
     conn.text_factory = str
     c = conn.cursor()
 
@@ -152,75 +320,47 @@ def redo_mirror_blocks(ledgerfile):
     max_height = c.fetchone()[0]
     max_height = (max_height // 1000) * 1000
 
-    # Remove old mirror entries
-    c.execute("DELETE FROM transactions WHERE address='Development Reward'")
-    c.execute("DELETE FROM transactions WHERE address='Hypernode Payouts'")
+    # Blocks up to the anchor of the last rebuild are unchanged
+    anchor = 0
+    state = load_mirror_state(state_file)
+    if state and state["height"] <= max_height \
+            and coinbase_hash(c, state["height"]) == state["block_hash"] \
+            and mirror_digest(db, state["height"]) == (state["rows"], state.get("digest")):
+        anchor = state["height"]
+        print(f"Mirror payouts unchanged up to block {anchor}")
+    elif state:
+        print("Mirror state does not match the ledger, rebuilding all mirror payouts")
+
+    print(f"Recomputing mirror payouts from block {anchor + 1} up to block {max_height}...")
+
+    last = min(max_height, HF4 - 1)
+    jobs = [(db, start, min(start + MIRROR_RANGE - 1, last)) for start in range(anchor + 1, last + 1, MIRROR_RANGE)]
+    payouts = []
+    with multiprocessing.Pool(workers or multiprocessing.cpu_count()) as pool:
+        for (_, start, end), result in zip(jobs, pool.imap(mirror_range, jobs)):
+            payouts.extend(result)
+            print(f"... processed {end}")
 
-    print(f"Recomputing mirror payouts up to block {max_height}...")
+    # Remove old mirror entries
+    if anchor:
+        c.execute("DELETE FROM transactions WHERE address='Development Reward' AND block_height < ?", (-anchor,))
+        c.execute("DELETE FROM transactions WHERE address='Hypernode Payouts' AND block_height < ?", (-anchor,))
+    else:
+        c.execute("DELETE FROM transactions WHERE address='Development Reward'")
+        c.execute("DELETE FROM transactions WHERE address='Hypernode Payouts'")
 
-    for bh in range(1, max_height + 1):
+    c.executemany(MIRROR_INSERT, (entry for payout in payouts for entry in mirror_entries(*payout)))
 
-        # Dev/HN payouts occur ONLY every 10th block
-        if bh % 10 != 0:
-            continue
+    conn.commit()
 
-        c.execute(
-            "SELECT * FROM transactions WHERE block_height=? ORDER BY rowid",
-            (bh,)
-        )
-        tx_list = c.fetchall()
-        if not tx_list:
-            continue
-
-        timestamp = tx_list[-1][1]  # timestamp of coinbase tx
-
-        # -------- Historical reward logic --------
-
-        if bh < HF1:
-            mining_reward = Decimal(15) - (Decimal(bh) / Decimal(1_000_000))
-            hn_reward = Decimal("0.0")
-
-        elif bh <= HF2:
-            mining_reward = (
-                Decimal(15)
-                - Decimal(bh) / Decimal(500_000)
-                - Decimal("0.8")
-            )
-            hn_reward = Decimal("8.0")   # 10 × 0.8
-
-        elif bh < HF3:
-            mining_reward = (
-                Decimal(15)
-                - Decimal(bh) / Decimal(500_000)
-                - Decimal("2.4")
-            )
-            hn_reward = Decimal("24.0")  # 10 × 2.4
-
-        else:
-            # BGV linear phase until tail
-            mining_reward = Decimal("5.5") - Decimal(bh - HF3) / Decimal("1100000")
-            hn_reward = Decimal("10.0") * (
-                Decimal("2.4") - (Decimal(bh - HF3 + 5) / Decimal("3000000"))
-            )
-            if mining_reward < Decimal("0.5"):
-                mining_reward = Decimal("0.5")
-            if hn_reward < Decimal("0.5"):
-                hn_reward = Decimal("0.5")
-
-        # HF4 removal of dev + HN entirely
-        if bh >= HF4:
-            mining_reward = Decimal("0")
-            hn_reward = Decimal("0")
-
-        # -----------------------------------------
-
-        mirror_hash = hashlib.blake2b(str(tx_list).encode(), digest_size=20).hexdigest()
-        dev_reward(c, bh, timestamp, mining_reward, hn_reward, mirror_hash)
-
-        if bh % 100_000 == 0:
-            print(f"... processed {bh}")
+    block_hash = coinbase_hash(c, max_height)
+    if state_file and block_hash is not None:
+        rows, digest = mirror_digest(db, max_height)
+        save_mirror_state(state_file, {"height": max_height,
+                                       "block_hash": block_hash,
+                                       "rows": rows,
+                                       "digest": digest})
 
-    conn.commit()
     c.close()
     conn.close()
 
@@ -247,42 +387,62 @@ if __name__ == "__main__":
         indexfile = "index_test.db"
         tgzfile = "testledger"
 
-    # Stop node
-    s = socks.socksocket()
-    s.settimeout(10)
-    try:
-        for _ in range(100):
-            s.connect(("127.0.0.1", port))
-            connections.send(s, "stop")
-            time.sleep(2)
-            s.close()
-            time.sleep(2)
-    except Exception:
-        app_log.info("Node stopped")
-
-    time.sleep(6)
-
-    # Recompute mirror payouts
-    if config.get("testnet") != "True":
-        app_log.info("Redoing mirror blocks")
-        redo_mirror_blocks(ledgerfile)
-        copyfile("static/hyper.db", config["DB_PATH"] + "hyper.db")
+    live = config.get("live_capture") == "True"
 
-    # Copy DBs to snapshot dir
-    copyfile(f"static/{indexfile}", config["DB_PATH"] + indexfile)
-    copyfile(f"static/{ledgerfile}", config["DB_PATH"] + ledgerfile)
+    if live:
+        # Copy DBs to snapshot dir while the node keeps running
+        pages = int(config.get("capture_pages", -1))
+        sleep = float(config.get("capture_sleep", 0.25))
+        restarts = int(config.get("capture_restarts", 10))
+        app_log.info("Capturing DBs from the running node")
+        capture_db(f"static/{ledgerfile}", config["DB_PATH"] + ledgerfile, pages, sleep, restarts)
+        block_height = max_block_height(config["DB_PATH"] + ledgerfile)
+        if config.get("testnet") != "True":
+            capture_db("static/hyper.db", config["DB_PATH"] + "hyper.db", pages, sleep, restarts)
+            # The copies are taken one after the other, use the height both reached
+            block_height = min(block_height, max_block_height(config["DB_PATH"] + "hyper.db"))
+        # Captured last, the index is at least as recent as the common height and is trimmed to it
+        capture_db(f"static/{indexfile}", config["DB_PATH"] + indexfile, pages, sleep, restarts)
 
-    block_height = max_block_height(config["DB_PATH"] + ledgerfile)
-    app_log.info(f"Restarting node")
+    else:
+        # Stop node
+        s = socks.socksocket()
+        s.settimeout(10)
+        try:
+            for _ in range(100):
+                s.connect(("127.0.0.1", port))
+                connections.send(s, "stop")
+                time.sleep(2)
+                s.close()
+                time.sleep(2)
+        except Exception:
+            app_log.info("Node stopped")
+
+        time.sleep(6)
+
+        # Recompute mirror payouts
+        if config.get("testnet") != "True":
+            app_log.info("Redoing mirror blocks")
+            # opt-in incremental rebuild, e.g. "mirror_state": "mirror_state.json"
+            redo_mirror_blocks(ledgerfile, state_file=config.get("mirror_state"))
+            copyfile("static/hyper.db", config["DB_PATH"] + "hyper.db")
 
-    os.system("screen -d -mS node python3 node.py")
+        # Copy DBs to snapshot dir
+        copyfile(f"static/{indexfile}", config["DB_PATH"] + indexfile)
+        copyfile(f"static/{ledgerfile}", config["DB_PATH"] + ledgerfile)
+
+        block_height = max_block_height(config["DB_PATH"] + ledgerfile)
+        app_log.info(f"Restarting node")
+
+        os.system("screen -d -mS node python3 node.py")
 
     block_height = (block_height // 1000) * 1000
     app_log.info(f"Max block_height = {block_height}")
 
     # Cleanup older snapshots
     for i in range(3, 10):
-        delete_ledger(f"{config['DB_PATH']}{tgzfile}-{block_height-i*1000}.tar.gz")
+        for extension in snapshot_archive.EXTENSIONS.values():
+            delete_ledger(f"{config['DB_PATH']}{tgzfile}-{block_height-i*1000}{extension}")
 
     # Trim DBs
     delete_column(config["DB_PATH"] + ledgerfile, block_height, "transactions")
@@ -290,12 +450,18 @@ if __name__ == "__main__":
     delete_column(config["DB_PATH"] + indexfile, block_height, "aliases")
     delete_column(config["DB_PATH"] + indexfile, block_height, "tokens")
 
+    # Recompute mirror payouts on the trimmed copy, its mirror entries are the node's own
+    if live and config.get("testnet") != "True":
+        app_log.info("Redoing mirror blocks")
+        redo_mirror_blocks(ledgerfile, directory=config["DB_PATH"])
+
     # Mirror integrity
     if config.get("testnet") != "True":
         delete_column(config["DB_PATH"] + "hyper.db", block_height, "transactions")
         ok = check_integrity(
             config["DB_PATH"] + "hyper.db",
-            config["DB_PATH"] + "ledger.db"
+            config["DB_PATH"] + "ledger.db",
+            compare=config.get("compare_dbs") == "True"
         )
     else:
         ok = True
@@ -309,29 +475,25 @@ if __name__ == "__main__":
             vacuum(config["DB_PATH"] + "hyper.db")
         vacuum(config["DB_PATH"] + indexfile)
 
-        filename = f"{tgzfile}-{block_height}.tar.gz"
+        codec = config.get("archive_codec", "gzip")
+        level = config.get("archive_level")
+        filename = f"{tgzfile}-{block_height}{snapshot_archive.EXTENSIONS[codec]}"
         tarpath = config["DB_PATH"] + filename
-        tar = tarfile.open(tarpath, "w:gz")
-        tar.add(config["DB_PATH"] + indexfile, arcname=indexfile)
-        tar.add(config["DB_PATH"] + ledgerfile, arcname=ledgerfile)
+        members = [(config["DB_PATH"] + indexfile, indexfile),
+                   (config["DB_PATH"] + ledgerfile, ledgerfile)]
         if config.get("testnet") != "True":
-            tar.add(config["DB_PATH"] + "hyper.db", arcname="hyper.db")
-        tar.close()
-
-        # SHA256
-        sha256 = hashlib.sha256()
-        with open(tarpath, "rb") as f:
-            while True:
-                chunk = f.read(65536)
-                if not chunk:
-                    break
-                sha256.update(chunk)
+            members.append((config["DB_PATH"] + "hyper.db", "hyper.db"))
+        archive = snapshot_archive.write_archive(tarpath, members, codec,
+                                                 None if level is None else int(level))
 
         data = {
             "url": config["url"] + filename,
             "filename": filename,
             "timestamp": int(time.time()),
-            "sha256": sha256.hexdigest(),
+            "sha256": archive["sha256"],
+            "size": archive["size"],
+            "members": archive["members"],
+            "codec": codec,
             "block_height": block_height
         }
 
@@ -4,12 +4,16 @@ Run the script inside the main Bismuth folder ~/Bismuth
 node.py must be stopped when running the script
 """
 
-import sqlite3,base64,hashlib,time,json,requests,tarfile,glob,sys
+import sqlite3,base64,hashlib,time,json,requests,glob,sys
 from quantizer import *
 from mining_heavy3 import *
 from Cryptodome.Hash import SHA
 import os.path
 import argparse
+from block_stream import iter_blocks, iter_diff_rows
+from block_serializer import compute_block_hash
+from sig_dupes import find_duplicate_signatures
+import snapshot_archive
 
 POW_FORK = 854660
 STEP = 10000 #Print steps
@@ -24,19 +28,14 @@ def purge(fileList):
             print("Error while deleting file : ", filePath)
 
 def check_dupes(db):
-    with sqlite3.connect(db) as ledger_check:
-        ledger_check.text_factory = str
-        h3 = ledger_check.cursor()
-
-    h3.execute("SELECT * FROM transactions WHERE signature IN (SELECT signature FROM transactions WHERE signature != '0' GROUP BY signature HAVING COUNT(*) >1)")
-    results = h3.fetchall()
+    results = find_duplicate_signatures(db)
 
     allowed_dupes = [708334,708335]
 
     bok = True
     for result in results:
         if result[0] not in allowed_dupes:
-            print ('Duplicate signature in block ' + result[0])
+            print ('Duplicate signature in block ' + str(result[0]))
             bok = False
 
     return bok
@@ -63,7 +62,6 @@ def verify_blocks(db,n):
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
-        h4 = ledger_check.cursor()
 
     try:
         h3.execute("SELECT * FROM misc order by block_height desc limit 1")
@@ -73,32 +71,12 @@ def verify_blocks(db,n):
         print_step = n
         invalid = 0
         db_block_hash_prev = ""
-        for row in h3.execute("SELECT * FROM transactions WHERE reward != 0 and "
-                "block_height>={} ORDER BY block_height".format(n-1)):
-            db_block_height = row[0]
-            db_block_hash = str(row[7])
+        for db_block_height, coinbase, transactions in iter_blocks(h3, n-1):
+            if coinbase is None:
+                continue
+            db_block_hash = str(coinbase[7])
             if db_block_height>=n:
-                transaction_list_converted = []
-                for transaction in h4.execute("SELECT * FROM transactions WHERE "
-                       "block_height={}".format(db_block_height)):
-                   q_received_timestamp = quantize_two(transaction[1])
-                   received_timestamp = '%.2f' % q_received_timestamp
-                   received_address = str(transaction[2])[:56]
-                   received_recipient = str(transaction[3])[:56]
-                   received_amount = '%.8f' % (quantize_eight(transaction[4]))
-                   received_signature_enc = str(transaction[5])[:684]
-                   received_public_key_hashed = str(transaction[6])[:1068]
-                   received_operation = str(transaction[10])
-                   received_openfield = str(transaction[11])
-
-                   transaction_list_converted.append((received_timestamp,
-                       received_address, received_recipient,
-                       received_amount, received_signature_enc,
-                       received_public_key_hashed, received_operation,
-                       received_openfield))
-
-                block_hash = hashlib.sha224((str(transaction_list_converted)
-                    + db_block_hash_prev).encode("utf-8")).hexdigest()
+                block_hash = compute_block_hash(transactions, db_block_hash_prev)
 
                 if block_hash != db_block_hash:
                     print("Block hash mismatch: {}"
@@ -117,7 +95,6 @@ def verify_blocks(db,n):
             print("{} invalid blocks found".format(invalid))
 
         h3.close()
-        h4.close()
 
     except Exception as e:
         print("Error: {}".format(e))
@@ -162,7 +139,6 @@ def verify_diff(db):
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
-        h4 = ledger_check.cursor()
 
     try:
         print("---> Verification of diffs started...")
@@ -173,16 +149,13 @@ def verify_diff(db):
         db_block_hash_prev = ""
         db_timestamp_prev = ""
 
-        for row in h3.execute('SELECT * FROM misc where block_height>854660 ORDER BY block_height'):
+        for row in iter_diff_rows(h3, 854660):
             db_block_height = row[0]
             db_diff = int(float(row[1]))
-
-            h4.execute("SELECT * FROM transactions WHERE block_height = {} and reward != 0".format(db_block_height))
-            result = h4.fetchall()[0]
-            db_timestamp = quantize_two(result[1])
-            miner_address = str(result[2])
-            db_block_hash = str(result[7])
-            db_nonce = str(result[11])
+            db_timestamp = quantize_two(row[2])
+            miner_address = str(row[3])
+            db_block_hash = str(row[4])
+            db_nonce = str(row[5])
 
             if len(db_block_hash_prev)>1:
                 bok = check_block(db_block_height,miner_address,db_nonce,db_block_hash_prev,db_diff,db_timestamp,
@@ -205,7 +178,6 @@ def verify_diff(db):
             print("{} invalid diffs found".format(invalid))
 
         h3.close()
-        h4.close()
 
     except Exception as e:
         print("Error: {}".format(e))
@@ -285,7 +257,9 @@ if __name__ == '__main__':
         j=args.snapshot-1
 
     if 0 <= j <len(data):
-        ledger = 'static/ledger.tar.gz'
+        # keep the extension of the snapshot url, e.g. ledger.tar.zst for a zstd archive
+        extension = next((e for e in snapshot_archive.EXTENSIONS.values() if data[j]['url'].endswith(e)), '.tar.gz')
+        ledger = 'static/ledger' + extension
         download_file(data[j]['url'],ledger)
 
         print("---> Checking file hash (sha256)")
@@ -298,27 +272,7 @@ if __name__ == '__main__':
             purge(glob.glob('static/*.db-shm'))
             purge(glob.glob('static/*.db-wal'))
             print("---> Extracting tar file")
-            with tarfile.open(ledger) as tar:
-                def is_within_directory(directory, target):
-                    
-                    abs_directory = os.path.abspath(directory)
-                    abs_target = os.path.abspath(target)
-                
-                    prefix = os.path.commonprefix([abs_directory, abs_target])
-                    
-                    return prefix == abs_directory
-                
-                def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-                
-                    for member in tar.getmembers():
-                        member_path = os.path.join(path, member.name)
-                        if not is_within_directory(path, member_path):
-                            raise Exception("Attempted Path Traversal in Tar File")
-                
-                    tar.extractall(path, members, numeric_owner=numeric_owner) 
-                    
-                
-                safe_extract(tar, "static/")
+            snapshot_archive.extract_archive(ledger, "static/")
 
             print("---> Verifying block hashes")
             db_hash = hash_blocks_until('static/ledger.db',DB_START)
@@ -4,11 +4,14 @@ Run the script inside the main Bismuth folder ~/Bismuth
 Local node can be running in parallel
 """
 
-import sqlite3, base64, hashlib, time, json, requests, tarfile
+import sqlite3, base64, hashlib, time, json, requests, tarfile, argparse
 from quantizer import *
 from mining_heavy3 import *
 from Cryptodome.Hash import SHA
 from decimal import Decimal
+from block_stream import iter_blocks, iter_diff_rows
+from block_serializer import compute_block_hash
+from sig_dupes import find_duplicate_signatures
 
 STEP = 10000  # Print steps
 DB_START = 900000
@@ -18,23 +21,11 @@ DB_HASH = "6ce0ed5c30b1181a676a2e9c870ae8fdf6f210e518e0f1f6ee923e20"
 HF4 = 4_380_000  # soft fork height: dev + HN rewards removed on chain
 
 
-def check_dupes(db):
-    """Look for duplicate signatures in the ledger (except a few allowed cases)."""
-    with sqlite3.connect(db) as ledger_check:
-        ledger_check.text_factory = str
-        h3 = ledger_check.cursor()
-
-        h3.execute("""
-            SELECT * FROM transactions
-            WHERE signature IN (
-                SELECT signature
-                FROM transactions
-                WHERE signature != '0'
-                GROUP BY signature
-                HAVING COUNT(*) > 1
-            )
-        """)
-        results = h3.fetchall()
+def check_dupes(db, index_file=None):
+    """Look for duplicate signatures in the ledger (except a few allowed cases)
+    With index_file, only the blocks added since the previous check are looked up
+    """
+    results = find_duplicate_signatures(db, index_file)
 
     allowed_dupes = [708334, 708335]
 
@@ -74,7 +65,6 @@ def verify_blocks(db, n):
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
-        h4 = ledger_check.cursor()
 
         try:
             h3.execute("SELECT * FROM misc ORDER BY block_height DESC LIMIT 1")
@@ -85,44 +75,13 @@ def verify_blocks(db, n):
             invalid = 0
             db_block_hash_prev = ""
 
-            for row in h3.execute(
-                "SELECT * FROM transactions WHERE reward != 0 "
-                "AND block_height >= ? ORDER BY block_height",
-                (n - 1,),
-            ):
-                db_block_height = row[0]
-                db_block_hash = str(row[7])
+            for db_block_height, coinbase, transactions in iter_blocks(h3, n - 1):
+                if coinbase is None:
+                    continue
+                db_block_hash = str(coinbase[7])
 
                 if db_block_height >= n:
-                    transaction_list_converted = []
-                    for transaction in h4.execute(
-                        "SELECT * FROM transactions WHERE block_height = ?",
-                        (db_block_height,),
-                    ):
-                        q_received_timestamp = quantize_two(transaction[1])
-                        received_timestamp = '%.2f' % q_received_timestamp
-                        received_address = str(transaction[2])[:56]
-                        received_recipient = str(transaction[3])[:56]
-                        received_amount = '%.8f' % (quantize_eight(transaction[4]))
-                        received_signature_enc = str(transaction[5])[:684]
-                        received_public_key_hashed = str(transaction[6])[:1068]
-                        received_operation = str(transaction[10])
-                        received_openfield = str(transaction[11])
-
-                        transaction_list_converted.append((
-                            received_timestamp,
-                            received_address,
-                            received_recipient,
-                            received_amount,
-                            received_signature_enc,
-                            received_public_key_hashed,
-                            received_operation,
-                            received_openfield
-                        ))
-
-                    block_hash = hashlib.sha224(
-                        (str(transaction_list_converted) + db_block_hash_prev).encode("utf-8")
-                    ).hexdigest()
+                    block_hash = compute_block_hash(transactions, db_block_hash_prev)
 
                     if block_hash != db_block_hash:
                         print("Block hash mismatch: {}".format(db_block_height))
@@ -140,7 +99,6 @@ def verify_blocks(db, n):
                 print("{} invalid blocks found".format(invalid))
 
             h3.close()
-            h4.close()
 
         except Exception as e:
             print("Error: {}".format(e))
@@ -194,7 +152,6 @@ def verify_diff(db):
     with sqlite3.connect(db) as ledger_check:
         ledger_check.text_factory = str
         h3 = ledger_check.cursor()
-        h4 = ledger_check.cursor()
 
         try:
             print("---> Verification of diffs started...")
@@ -205,22 +162,13 @@ def verify_diff(db):
             db_block_hash_prev = ""
             db_timestamp_prev = ""
 
-            for row in h3.execute(
-                "SELECT * FROM misc WHERE block_height > 854660 ORDER BY block_height"
-            ):
+            for row in iter_diff_rows(h3, 854660):
                 db_block_height = row[0]
                 db_diff = int(float(row[1]))
-
-                h4.execute(
-                    "SELECT * FROM transactions "
-                    "WHERE block_height = ? AND reward != 0",
-                    (db_block_height,),
-                )
-                result = h4.fetchall()[0]
-                db_timestamp = quantize_two(result[1])
-                miner_address = str(result[2])
-                db_block_hash = str(result[7])
-                db_nonce = str(result[11])
+                db_timestamp = quantize_two(row[2])
+                miner_address = str(row[3])
+                db_block_hash = str(row[4])
+                db_nonce = str(row[5])
 
                 if len(db_block_hash_prev) > 1:
                     bok = check_block(
@@ -251,7 +199,6 @@ def verify_diff(db):
                 print("{} invalid diffs found".format(invalid))
 
             h3.close()
-            h4.close()
 
         except Exception as e:
             print("Error: {}".format(e))
@@ -336,6 +283,11 @@ def check_post_hf4_rewards(db, hf4=HF4):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Verify the local Bismuth snapshot ledger.')
+    parser.add_argument('--dupes-index', default=None,
+                        help='digest index file, later duplicate signature checks only read the new blocks')
+    args = parser.parse_args()
+
     print("Functions included from the mining_heavy3 module")
     print("Verifying static/ledger.db")
 
@@ -352,7 +304,7 @@ if __name__ == '__main__':
     print("---> Verifying mining difficulties")
     verify_diff('static/ledger.db')
     print("---> Looking for duplicate signatures")
-    bok = check_dupes('static/ledger.db')
+    bok = check_dupes('static/ledger.db', args.dupes_index)
     if bok:
         print("No duplicate signatures found")
     print("---> Checking HF4 reward removal (no dev/HN after 4,380,000)")
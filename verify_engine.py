@@ -0,0 +1,78 @@
+"""
+Single scan verification engine for the Bismuth ledger
+One ordered pass over the transactions table feeds every registered check,
+so the ledger is read from disk once whatever the number of checks
+"""
+
+import sqlite3
+from block_stream import iter_blocks
+
+
+class Check:
+    """Base class of the checks run by scan_ledger
+
+    on_block is called for every block with its rows in rowid order, on_mirror for every
+    mirror row (negative block_height). Each check keeps its own invalid count and logs
+    its own mismatches.
+    """
+
+    name = 'check'
+
+    def __init__(self, app_log):
+        self.app_log = app_log
+        self.invalid = 0
+
+    def on_block(self, block_height, coinbase, transactions):
+        pass
+
+    def on_mirror(self, row):
+        pass
+
+    def fail(self, message):
+        self.app_log.warning(message)
+        self.invalid = self.invalid + 1
+
+    def finish(self):
+        if self.invalid == 0:
+            self.app_log.info("{}: all entries in the local ledger are valid".format(self.name))
+        else:
+            self.app_log.warning("{}: {} invalid entries found".format(self.name, self.invalid))
+
+
+def scan_ledger(app_log, db, checks, print_step=100000):
+    """Runs all checks in one ordered scan of transactions, returns {check name: invalid count}"""
+    with sqlite3.connect(db) as ledger_check:
+        ledger_check.text_factory = str
+        h3 = ledger_check.cursor()
+
+    try:
+        app_log.info("Single scan verification started: {}".format(", ".join(check.name for check in checks)))
+        h3.execute("SELECT min(block_height) FROM transactions")
+        first = h3.fetchone()[0]
+        next_step = print_step
+
+        # mirror rows have negative heights and come first
+        for block_height, coinbase, transactions in iter_blocks(h3, first if first is not None else 0):
+            if block_height < 0:
+                for row in transactions:
+                    for check in checks:
+                        check.on_mirror(row)
+                continue
+
+            for check in checks:
+                check.on_block(block_height, coinbase, transactions)
+
+            if block_height > next_step:
+                app_log.info("Bismuth ledger scanned, block = {}".format(next_step))
+                next_step += print_step
+
+        for check in checks:
+            check.finish()
+
+        h3.close()
+
+    except Exception as e:
+        app_log.error("Error: {}".format(e))
+        raise
+
+    return {check.name: check.invalid for check in checks}
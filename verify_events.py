@@ -0,0 +1,36 @@
+"""
+Structured events of the ledger_verify stages
+The iter_verify_* generators of ledger_verify yield these events while a stage runs,
+async_events makes them usable from asyncio
+"""
+
+import asyncio
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# height verified so far out of last, rate in blocks per second since the stage started
+Progress = namedtuple('Progress', 'stage height last rate')
+# an invalid entry: height, reason as logged ("Block hash mismatch"...) and optional detail
+Mismatch = namedtuple('Mismatch', 'stage height reason detail')
+# end of a stage, invalid is the total including entries counted before a resume
+StageDone = namedtuple('StageDone', 'stage height invalid')
+
+
+async def async_events(events):
+    """Async generator yielding the events of a verification generator run in a worker thread
+
+    The generator always runs in the same thread, its SQLite connections are bound to it.
+    Leaving the loop through contextlib.aclosing closes the generator, which stops the stage.
+    """
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=1)
+    done = object()
+    try:
+        while True:
+            event = await loop.run_in_executor(executor, next, events, done)
+            if event is done:
+                break
+            yield event
+    finally:
+        await loop.run_in_executor(executor, events.close)
+        executor.shutdown(wait=False)
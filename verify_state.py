@@ -0,0 +1,101 @@
+"""
+Persistent state of ledger_verify runs
+Checkpoint keeps the progress of every verification stage so an interrupted run can be resumed
+The verified tip of a stage is the last block it verified in a valid run, later runs only verify what follows it
+"""
+
+import os
+import json
+
+
+def write_json(filename, data):
+    """Writes data through a temporary file, a crash never leaves a partial file"""
+    temp = filename + '.tmp'
+    with open(temp, 'w') as outfile:
+        json.dump(data, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temp, filename)
+
+
+class Checkpoint:
+    """Last verified height of each stage, written atomically to a json file
+
+    For every stage the file records the last verified height, the invalid count so far,
+    the stored hash and timestamp of the block at that height and whether the stage is done.
+    """
+
+    def __init__(self, filename, every=100000):
+        self.filename = filename
+        self.every = every
+        self.stages = {}
+
+    def load(self):
+        """Reads the checkpoint file, returns False if there is none"""
+        if not os.path.isfile(self.filename):
+            return False
+        with open(self.filename) as json_data:
+            self.stages = json.load(json_data)
+        return True
+
+    def stage(self, name):
+        """Returns the saved state of a stage, None if it was not started"""
+        return self.stages.get(name)
+
+    def due(self, name, height):
+        """True if at least every blocks were verified since the stage was last saved"""
+        state = self.stages.get(name)
+        return height - (state['height'] if state else 0) >= self.every
+
+    def update(self, name, height, invalid, block_hash_prev, timestamp_prev, done=False):
+        self.stages[name] = {'height': height,
+                             'invalid': invalid,
+                             'block_hash_prev': block_hash_prev,
+                             'timestamp_prev': timestamp_prev,
+                             'done': done}
+        self.save()
+
+    def seed(self, name, tip):
+        """Starts a stage after its verified tip, as verified up to there without invalid entries"""
+        self.stages[name] = {'height': tip['block_height'],
+                             'invalid': 0,
+                             'block_hash_prev': tip['block_hash'],
+                             'timestamp_prev': tip['timestamp'],
+                             'done': False}
+        self.save()
+
+    def tips(self):
+        """Returns {stage: tip} of the stages that are done, the tip being their last verified block"""
+        return {name: {'block_height': state['height'],
+                       'block_hash': state['block_hash_prev'],
+                       'timestamp': state['timestamp_prev']}
+                for name, state in self.stages.items() if state['done']}
+
+    def reset(self, name):
+        self.stages.pop(name, None)
+        self.save()
+
+    def save(self):
+        write_json(self.filename, self.stages)
+
+    def remove(self):
+        self.stages = {}
+        if os.path.isfile(self.filename):
+            os.remove(self.filename)
+
+
+def load_tips(filename):
+    """Returns {stage: tip} saved by the last valid runs, {} if there is none
+
+    The tip of a stage is the height, block_hash and timestamp of the last block it verified.
+    """
+    if not os.path.isfile(filename):
+        return {}
+    with open(filename) as json_data:
+        tips = json.load(json_data)
+    # a file of the earlier format holds one tip for all stages, it may be above what some of them verified
+    return {} if 'block_height' in tips else tips
+
+
+def save_tips(filename, tips):
+    write_json(filename, tips)